@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Checks that starting up doesn't import more than it needs to.
+
+Both sides of the buildah unshare re-exec are checked: the outer process only
+reads the script, and the inner one runs it. Neither should import modules
+that only some scripts use (downloads, copies, venvs), and the time taken by
+buildahscript's imports is compared against bench/baseline.json.
+
+    python bench/imports.py           # check
+    python bench/imports.py --save    # check, and save the times as the baseline
+"""
+import argparse
+import json
+import pathlib
+import subprocess
+import sys
+
+BENCH = pathlib.Path(__file__).resolve().parent
+REPO = BENCH.parent
+BASELINE = BENCH / 'baseline.json'
+
+#: How much slower than the baseline counts as a regression
+TOLERANCE = 0.25
+
+# Only wanted by scripts that use them
+LAZY = [
+    'buildahscript.download',
+    'buildahscript.venv',
+    'buildahscript._fsutil',
+    'urllib.request',
+    'http.client',
+    'concurrent.futures',
+    'venv',
+]
+
+# Only wanted once inside buildah unshare
+INNER_ONLY = [
+    'buildahscript.modglobals',
+    'buildahscript.cleanup',
+]
+
+PHASES = {
+    # What main_outer() needs
+    'outer': ['buildahscript.cli'],
+    # What main_inner() needs, up until the script runs
+    'inner': ['buildahscript.cli', 'buildahscript.modglobals'],
+}
+
+
+def importtime(modules):
+    """
+    Imports modules in a fresh interpreter, returning {module: cumulative
+    microseconds} for everything that got imported.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', '; '.join(f"import {m}" for m in modules)],
+        cwd=REPO, stderr=subprocess.PIPE, text=True, check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per phase')
+    parser.add_argument('--save', action='store_true', help='save the times as the baseline')
+    args = parser.parse_args()
+
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    failed = False
+    for phase, modules in PHASES.items():
+        runs = [importtime(modules) for _ in range(args.repeat)]
+        lazy = LAZY + INNER_ONLY if phase == 'outer' else LAZY
+        eager = sorted(m for m in lazy if m in runs[0])
+        # The fastest run is the one least disturbed by everything else
+        micros = min(sum(times.get(m, 0) for m in modules) for times in runs)
+        name = f"imports-{phase}"
+        note = ''
+        if name in baseline:
+            change = micros / baseline[name]['import_us'] - 1
+            note = f"{change:+.0%}"
+            if change > TOLERANCE:
+                note += ' REGRESSED'
+                failed = True
+        print(f"{phase:<6} {micros / 1000:>7.1f}ms  {note}")
+        if eager:
+            print(f"  imported eagerly: {', '.join(eager)}")
+            failed = True
+        if args.save:
+            baseline[name] = {'import_us': micros}
+
+    if args.save:
+        BASELINE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+        print(f"Saved baseline to {BASELINE}")
+    elif failed:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Measures how much time buildahscript itself adds on top of buildah.
+
+Each scenario runs a build script against the fake buildah in bench/bin, and
+records the wall time, the number of buildah calls, and the peak RSS of the
+process tree. Results are compared against bench/baseline.json.
+
+    python bench/run.py                 # run, compare against the baseline
+    python bench/run.py --save          # run, and save as the new baseline
+    python bench/run.py -k synthetic    # only scenarios matching a string
+"""
+import argparse
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = pathlib.Path(__file__).resolve().parent
+REPO = BENCH.parent
+DEMOS = REPO / 'demos'
+BASELINE = BENCH / 'baseline.json'
+
+#: How much slower than the baseline counts as a regression
+TOLERANCE = 0.25
+
+
+def synthetic_steps(count):
+    """
+    A script with lots of small steps
+    """
+    lines = ['with Container("alpine") as cont:']
+    for n in range(count):
+        lines += [
+            f"    cont.environ['VAR{n}'] = '{n}'",
+            f"    cont.run(['echo', 'step {n}'], stdout=subprocess.DEVNULL)",
+        ]
+    lines += ['    return cont.commit()']
+    return 'import subprocess\n' + '\n'.join(lines) + '\n'
+
+
+def synthetic_metadata(count):
+    """
+    A script with lots of metadata to parse, and a big body to compile
+    """
+    lines = [f"#| arg: arg{n}: int = {n}" for n in range(count)]
+    lines += [f"value{n} = arg{n} * 2" for n in range(count)]
+    lines += ['with Container("scratch") as cont:', '    return cont.commit()']
+    return '\n'.join(lines) + '\n'
+
+
+def synthetic_stages(count):
+    """
+    A multi-stage build
+    """
+    lines = ['import tempfile', 'with tempfile.TemporaryDirectory() as td:']
+    for n in range(count):
+        lines += [
+            f"    with Container('stage{n}:latest') as build:",
+            f"        build.copy_out('/etc/os-release', f'{{td}}/release{n}')",
+        ]
+    lines += ["    with Container('alpine') as cont:"]
+    for n in range(count):
+        lines += [f"        cont.copy_in(f'{{td}}/release{n}', '/release{n}')"]
+    lines += ['        return cont.commit()']
+    return '\n'.join(lines) + '\n'
+
+
+# name -> (script path or source, extra args, extra environment)
+SCENARIOS = {
+    'startup': ('with Container("scratch") as cont:\n    pass\n', [], {}),
+    'demo-hello-world': (DEMOS / 'hello-world', [], {}),
+    'demo-args': (DEMOS / 'args', ['--build-arg', 'msg=hi'], {}),
+    'demo-run': (DEMOS / 'run', [], {}),
+    'demo-copy': (DEMOS / 'copy', [], {}),
+    'demo-mount': (DEMOS / 'mount', [], {}),
+    'demo-inspect': (DEMOS / 'inspect', [], {}),
+    'demo-parallel': (DEMOS / 'parallel', [], {}),
+    'synthetic-steps': (synthetic_steps(50), [], {}),
+    'synthetic-metadata': (synthetic_metadata(2000), [], {}),
+    'synthetic-stages': (synthetic_stages(4), [], {}),
+    'synthetic-big-store': (synthetic_stages(4), [], {'FAKE_BUILDAH_IMAGES': '5000'}),
+}
+
+
+def find_buildahscript(bindir):
+    """
+    Makes sure there's a buildahscript-py to run (the re-exec needs one on
+    PATH), using this checkout.
+    """
+    shim = bindir / 'buildahscript-py'
+    shim.write_text(
+        f"#!{sys.executable}\n"
+        "import sys\n"
+        f"sys.path.insert(0, {str(REPO)!r})\n"
+        "from buildahscript.cli import main\n"
+        "sys.exit(main())\n"
+    )
+    shim.chmod(0o755)
+    return shim
+
+
+def run_once(script, args, env):
+    """
+    Runs a build, returning (seconds, buildah calls, peak RSS in KiB).
+    """
+    with tempfile.TemporaryDirectory() as state:
+        log = pathlib.Path(state) / 'calls.log'
+        env = dict(
+            env,
+            FAKE_BUILDAH_STATE=os.path.join(state, 'buildah'),
+            FAKE_BUILDAH_LOG=str(log),
+            BUILDAHSCRIPT_CACHE_DIR=os.path.join(state, 'cache'),
+        )
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            ['buildahscript-py', str(script), *args], env=env, cwd=state,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        stderr = proc.stderr.read().decode('utf-8', 'replace')
+        proc.stderr.close()
+        if status != 0:
+            raise RuntimeError(f"{script} failed:\n{stderr}")
+        calls = len(log.read_text().splitlines()) if log.exists() else 0
+        return elapsed, calls, usage.ru_maxrss
+
+
+def run_scenario(name, repeat, bindir, workdir):
+    source, args, extra_env = SCENARIOS[name]
+    if isinstance(source, str):
+        script = workdir / name
+        script.write_text(source)
+    else:
+        script = source
+    env = dict(os.environ, **extra_env)
+    env['PATH'] = os.pathsep.join([str(BENCH / 'bin'), str(bindir), env.get('PATH', '')])
+    results = [run_once(script, args, env) for _ in range(repeat)]
+    return {
+        'wall': statistics.median(r[0] for r in results),
+        'calls': max(r[1] for r in results),
+        'rss_kib': max(r[2] for r in results),
+    }
+
+
+def compare(name, result, baseline):
+    """
+    Describe how result compares to the baseline, and if it regressed.
+    """
+    if name not in baseline:
+        return 'new', False
+    base = baseline[name]
+    notes = []
+    regressed = False
+    change = result['wall'] / base['wall'] - 1
+    notes.append(f"{change:+.0%} wall")
+    if change > TOLERANCE:
+        regressed = True
+    if result['calls'] != base['calls']:
+        notes.append(f"{result['calls'] - base['calls']:+d} calls")
+        regressed = regressed or result['calls'] > base['calls']
+    return ', '.join(notes), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-k', dest='filter', help='only run scenarios containing this')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--latency', help='seconds the fake buildah sleeps per call')
+    args = parser.parse_args()
+
+    if args.latency:
+        os.environ['FAKE_BUILDAH_LATENCY'] = args.latency
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+
+    results = {}
+    regressions = []
+    print(f"{'scenario':<24} {'wall':>9} {'calls':>6} {'rss':>9}  vs baseline")
+    with tempfile.TemporaryDirectory() as tmp:
+        bindir = pathlib.Path(tmp) / 'bin'
+        bindir.mkdir()
+        find_buildahscript(bindir)
+        for name in SCENARIOS:
+            if args.filter and args.filter not in name:
+                continue
+            result = results[name] = run_scenario(name, args.repeat, bindir, pathlib.Path(tmp))
+            note, regressed = compare(name, result, baseline)
+            if regressed:
+                regressions.append(name)
+            print(
+                f"{name:<24} {result['wall']:>8.3f}s {result['calls']:>6} "
+                f"{result['rss_kib'] / 1024:>7.1f}MB  {note}{' REGRESSED' if regressed else ''}"
+            )
+
+    if args.save:
+        baseline.update(results)
+        BASELINE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+        print(f"Saved baseline to {BASELINE}")
+    elif regressions:
+        print(f"Regressed: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+"""
+Filesystem helpers
+"""
+import concurrent.futures
+import dataclasses
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import time
+
+# copy_file_range() refuses these sorts of copies; use plain copies instead
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+
+def copy_file(src, dst):
+    """
+    Copies the contents of src to dst, returning the number of bytes copied.
+
+    Uses copy_file_range() where it can, which stays in the kernel and shares
+    extents (reflinks) on filesystems that support it.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if hasattr(os, 'copy_file_range'):
+            copied = 0
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as exc:
+                if exc.errno not in _FALLBACK_ERRNOS:
+                    raise
+            else:
+                if copied == size:
+                    return size
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        return size
+
+
+@dataclasses.dataclass
+class CopyStats:
+    """
+    What a tree copy did
+    """
+    files_copied: int = 0
+    bytes_copied: int = 0
+    files_skipped: int = 0
+    bytes_skipped: int = 0
+    files_deleted: int = 0
+    seconds: float = 0.0
+
+
+def _same_file(src_st, dst_st, src, dst, checksum):
+    if not stat.S_ISREG(dst_st.st_mode):
+        return False
+    if src_st.st_size != dst_st.st_size or src_st.st_mtime_ns != dst_st.st_mtime_ns:
+        return False
+    if checksum:
+        return _hash_file(src) == _hash_file(dst)
+    return True
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        count = sum(len(files) for _, _, files in os.walk(path))
+        shutil.rmtree(path)
+        return count
+    else:
+        os.unlink(path)
+        return 1
+
+
+def _lexists(path):
+    try:
+        return os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _copy_regular(src, dst):
+    size = copy_file(src, dst)
+    shutil.copystat(src, dst)
+    return size
+
+
+def copy_tree(src, dst, *, sync=False, checksum=False, delete=True, overwrite=False, jobs=8):
+    """
+    Copies the file or directory src to dst, preserving symlinks, modes and
+    timestamps. Special files (devices, fifos, sockets) are skipped.
+
+    By default, dst is replaced outright. If sync is true, dst is instead
+    updated in place: files whose size and mtime (and, if checksum is true,
+    contents) match are left alone, and files not in src are deleted (unless
+    delete is false). With overwrite, every file is copied anyway, and only
+    directories are merged.
+
+    File contents are copied by a pool of jobs threads. Returns a CopyStats.
+    """
+    start = time.perf_counter()
+    stats = CopyStats()
+    src, dst = str(src), str(dst)
+
+    existing = _lexists(dst)
+    if existing is not None and not sync:
+        stats.files_deleted += _remove(dst)
+        existing = None
+
+    copies = []
+    dirs = []
+
+    def visit(srcpath, dstpath, dst_st):
+        src_st = os.lstat(srcpath)
+        if dst_st is not None and stat.S_IFMT(dst_st.st_mode) != stat.S_IFMT(src_st.st_mode):
+            stats.files_deleted += _remove(dstpath)
+            dst_st = None
+
+        if stat.S_ISDIR(src_st.st_mode):
+            if dst_st is None:
+                os.mkdir(dstpath)
+            names = set(os.listdir(srcpath))
+            if dst_st is not None and delete:
+                for name in set(os.listdir(dstpath)) - names:
+                    stats.files_deleted += _remove(os.path.join(dstpath, name))
+            for name in sorted(names):
+                child = os.path.join(dstpath, name)
+                visit(os.path.join(srcpath, name), child, _lexists(child) if dst_st else None)
+            # Directory timestamps are set last, once nothing else touches them
+            dirs.append((srcpath, dstpath))
+        elif stat.S_ISLNK(src_st.st_mode):
+            target = os.readlink(srcpath)
+            if dst_st is not None:
+                if os.readlink(dstpath) == target:
+                    return
+                os.unlink(dstpath)
+            os.symlink(target, dstpath)
+            stats.files_copied += 1
+        elif stat.S_ISREG(src_st.st_mode):
+            if (
+                dst_st is not None and not overwrite
+                and _same_file(src_st, dst_st, srcpath, dstpath, checksum)
+            ):
+                stats.files_skipped += 1
+                stats.bytes_skipped += src_st.st_size
+            else:
+                copies.append((srcpath, dstpath))
+
+    visit(src, dst, existing)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        for size in pool.map(lambda pair: _copy_regular(*pair), copies):
+            stats.files_copied += 1
+            stats.bytes_copied += size
+
+    for srcpath, dstpath in reversed(dirs):
+        shutil.copystat(srcpath, dstpath)
+
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+def add_stats(total, stats):
+    """
+    Accumulate stats into total
+    """
+    for field in dataclasses.fields(CopyStats):
+        if field.name != 'seconds':
+            setattr(total, field.name, getattr(total, field.name) + getattr(stats, field.name))
+
+
+def resolve_in_root(root, path):
+    """
+    Resolves path as if root were /, following symlinks the way the container
+    would see them.
+    """
+    root = os.path.abspath(root)
+    parts = [p for p in path.split('/') if p not in ('', '.')]
+    current = root
+    hops = 0
+    while parts:
+        part = parts.pop(0)
+        if part == '..':
+            if current != root:
+                current = os.path.dirname(current)
+            continue
+        candidate = os.path.join(current, part)
+        if os.path.islink(candidate):
+            hops += 1
+            if hops > 40:
+                raise OSError(errno.ELOOP, "Too many levels of symbolic links", path)
+            target = os.readlink(candidate)
+            if target.startswith('/'):
+                current = root
+            parts = [p for p in target.split('/') if p not in ('', '.')] + parts
+        else:
+            current = candidate
+    return current
@@ -0,0 +1,210 @@
+"""
+Measures what's taking up space in a container's filesystem
+"""
+import concurrent.futures
+import dataclasses
+import os
+import stat
+import sys
+import time
+import typing
+
+from .cache import format_size
+
+
+@dataclasses.dataclass
+class Diff:
+    """
+    What changed between two snapshots, in bytes, with the biggest changes
+    as (size, path, "added"/"modified"/"deleted") tuples.
+    """
+    added: int = 0
+    modified: int = 0
+    deleted: int = 0
+    largest: typing.List[typing.Tuple[int, str, str]] = dataclasses.field(default_factory=list)
+
+    def __str__(self):
+        return (
+            f"+{format_size(self.added)} added, {format_size(self.modified)} modified, "
+            f"-{format_size(self.deleted)} deleted"
+        )
+
+
+class Snapshot:
+    """
+    The sizes of everything in a filesystem at one point in the build, from
+    scan(). Paths are relative to the root, with a leading /.
+    """
+    #: Total size of all files, counting hardlinks once
+    total: int
+    #: How many files (of any type, not counting directories)
+    files: int
+    #: How long the scan took
+    seconds: float
+
+    def __init__(self, entries, dir_sizes, seconds):
+        # path -> (size, mtime, ctime) for everything but directories
+        self._entries = entries
+        # path -> size of everything under it
+        self._dir_sizes = dir_sizes
+        self.total = dir_sizes.get('/', 0)
+        self.files = len(entries)
+        self.seconds = seconds
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {format_size(self.total)} in {self.files} files>"
+
+    def largest_files(self, count=10):
+        """
+        The biggest files, as (size, path) pairs, biggest first.
+        """
+        return sorted(((e[0], p) for p, e in self._entries.items()), reverse=True)[:count]
+
+    def largest_dirs(self, count=10):
+        """
+        The biggest directories (counting everything under them), as (size,
+        path) pairs, biggest first.
+        """
+        return sorted(
+            ((s, p) for p, s in self._dir_sizes.items() if p != '/'), reverse=True,
+        )[:count]
+
+    def diff(self, before, *, count=10):
+        """
+        What changed since the snapshot before. Modified files are counted at
+        their new size, since that's what a layer would hold.
+        """
+        result = Diff()
+        changes = []
+        for path, entry in self._entries.items():
+            old = before._entries.get(path)
+            if old is None:
+                result.added += entry[0]
+                changes.append((entry[0], path, 'added'))
+            elif old != entry:
+                result.modified += entry[0]
+                changes.append((entry[0], path, 'modified'))
+        for path, entry in before._entries.items():
+            if path not in self._entries:
+                result.deleted += entry[0]
+                changes.append((entry[0], path, 'deleted'))
+        result.largest = sorted(changes, reverse=True)[:count]
+        return result
+
+    def report(self, *, count=10, file=None):
+        """
+        Prints the total and the biggest directories and files.
+        """
+        file = file or sys.stderr
+        print(
+            f"{format_size(self.total)} in {self.files} files (scanned in {self.seconds:.2f}s)",
+            file=file,
+        )
+        print("Largest directories:", file=file)
+        for size, path in self.largest_dirs(count):
+            print(f"  {format_size(size):>9}  {path}", file=file)
+        print("Largest files:", file=file)
+        for size, path in self.largest_files(count):
+            print(f"  {format_size(size):>9}  {path}", file=file)
+
+
+def _scan_dir(root, rel):
+    """
+    Lists one directory, giving its entries as {path: (size, mtime, ctime)},
+    the total size of its files, its hardlinked files as (inode key, size,
+    directory), and its subdirectories. Hardlinked files aren't in the total.
+    """
+    entries = {}
+    total = 0
+    linked = []
+    subdirs = []
+    prefix = '/' if rel == '/' else rel + '/'
+    try:
+        it = os.scandir(root + rel)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return entries, total, linked, subdirs
+    with it:
+        for entry in it:
+            path = prefix + entry.name
+            # Uses the type from the directory listing, no stat() needed
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(path)
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+            entries[path] = (size, st.st_mtime_ns, st.st_ctime_ns)
+            if st.st_nlink > 1 and size:
+                linked.append(((st.st_dev, st.st_ino), size, rel))
+            else:
+                total += size
+    return entries, total, linked, subdirs
+
+
+#: Directories this deep or shallower are handed out to the pool; deeper
+#: ones are walked by whichever thread found them, which saves on handoffs
+SPLIT_DEPTH = 3
+
+
+def _scan_tree(root, rel):
+    """
+    Walks the directory rel and everything under it down to SPLIT_DEPTH.
+    Gives its entries, {directory: size of its files}, hardlinked files, and
+    the subdirectories at SPLIT_DEPTH left for someone else.
+    """
+    entries = {}
+    direct = {}
+    linked = []
+    deferred = []
+    stack = [rel]
+    while stack:
+        path = stack.pop()
+        found, direct[path], found_linked, subdirs = _scan_dir(root, path)
+        entries.update(found)
+        linked += found_linked
+        for child in subdirs:
+            if child.count('/') <= SPLIT_DEPTH:
+                deferred.append(child)
+            else:
+                stack.append(child)
+    return entries, direct, linked, deferred
+
+
+def scan(root, *, jobs=8):
+    """
+    Walks the filesystem under root, with jobs threads listing directories at
+    once, and returns a Snapshot.
+    """
+    start = time.perf_counter()
+    root = os.fspath(root).rstrip('/')
+    entries = {}
+    direct = {}
+    seen_inodes = set()
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        pending = {pool.submit(_scan_tree, root, '/')}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                found, sizes, linked, deferred = future.result()
+                entries.update(found)
+                direct.update(sizes)
+                for inode, size, parent in linked:
+                    # Other links to it are free
+                    if inode not in seen_inodes:
+                        seen_inodes.add(inode)
+                        direct[parent] += size
+                for child in deferred:
+                    pending.add(pool.submit(_scan_tree, root, child))
+    # Roll sizes up into parents, deepest first
+    dir_sizes = dict(direct)
+    for path in sorted(dir_sizes, key=lambda p: p.count('/'), reverse=True):
+        if path != '/':
+            parent = path.rsplit('/', 1)[0] or '/'
+            dir_sizes[parent] += dir_sizes[path]
+
+    return Snapshot(entries, dir_sizes, time.perf_counter() - start)
@@ -0,0 +1,215 @@
+"""
+Runs many builds (scripts, or build arg combinations) in one go
+"""
+import concurrent.futures
+import itertools
+import json
+import os
+import selectors
+import sys
+import time
+
+from .daemon import fork_build, reap_build
+from .runner import ImageRefs, load_script, parse_buildargs
+
+
+def load_matrix(path):
+    """
+    Reads a build arg matrix: a JSON object of arg names to lists of values
+    (every combination is built), or a list of such objects (each of which is
+    expanded, and the results concatenated). Gives dicts of args.
+    """
+    with open(path, 'rt') as fobj:
+        matrix = json.load(fobj)
+    if isinstance(matrix, dict):
+        matrix = [matrix]
+    for axes in matrix:
+        names = list(axes)
+        values = [v if isinstance(v, list) else [v] for v in axes.values()]
+        for combo in itertools.product(*values):
+            yield dict(zip(names, combo))
+
+
+def _fill(template, fields, option):
+    """
+    Fills in a --tag, --push or --export template with a variant's fields.
+    """
+    try:
+        return template.format_map(fields)
+    except KeyError as exc:
+        raise ValueError(
+            f"{option} {template}: {{{exc.args[0]}}} isn't a build arg (or {{script}})"
+        ) from None
+    except (ValueError, IndexError) as exc:
+        raise ValueError(f"{option} {template}: {exc}") from None
+
+
+def check(args):
+    """
+    Makes sure every variant's tags, pushes and exports can be filled in, and
+    that no two variants would export to the same file. Raises ValueError if
+    not.
+    """
+    requests = list(variants(args))
+    exports = [request['export'] for request in requests]
+    if args.export and len(set(exports)) < len(exports):
+        raise ValueError(
+            f"--export {args.export} would be the same file for more than one build; "
+            "use the build args in it, like out-{version}.tar"
+        )
+
+
+def variants(args):
+    """
+    Build requests for every script and matrix combination.
+    """
+    fixed = dict(kv.split('=', 1) for kv in args.args or [])
+    combos = list(load_matrix(args.matrix)) if args.matrix else [{}]
+    for script in args.scripts:
+        for combo in combos:
+            values = dict(fixed, **{k: str(v) for k, v in combo.items()})
+            fields = dict(values, script=os.path.splitext(os.path.basename(script))[0])
+            yield {
+                'script': os.path.abspath(script),
+                'args': [f"{k}={v}" for k, v in values.items()],
+                # Tags can vary too: -t myimage:{version}
+                'tags': [_fill(tag, fields, '--tag') for tag in args.tags or []],
+                'push': [_fill(dest, fields, '--push') for dest in args.push or []],
+                'export': args.export and os.path.abspath(_fill(args.export, fields, '--export')),
+                'export_format': args.export_format,
+                'compression': args.compression,
+                'compression_level': args.compression_level,
+                'layer_cache': args.layer_cache,
+                'analyze': args.analyze,
+                'pull': args.pull,
+                'cwd': os.getcwd(),
+                'label': ' '.join([
+                    os.path.basename(script), *(f"{k}={v}" for k, v in combo.items()),
+                ]),
+            }
+
+
+def _prepare(requests, jobs):
+    """
+    Does what the builds have in common up front, once: compiling scripts,
+    resolving (and pulling) base images, and building venvs. The forked
+    builds inherit the results.
+    """
+    from . import modglobals
+    from .venv import cached_venv
+
+    refs = set()
+    deps = set()
+    for request in requests:
+        try:
+            script = load_script(request['script'])
+            buildargs = parse_buildargs(
+                script.metadata.args, dict(kv.split('=', 1) for kv in request['args']),
+            )
+        except Exception:
+            # Leave it to fail as part of its own build, not take the rest down
+            continue
+        refs |= ImageRefs.resolve(script.images, buildargs)
+        if script.metadata.deps:
+            deps.add(tuple(script.metadata.deps))
+
+    if requests[0]['pull'] is not None:
+        modglobals.Image.pull_policy = requests[0]['pull']
+    modglobals.prefetch(refs)
+
+    def make_venv(reqs):
+        with cached_venv(list(reqs)):
+            pass
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        # list() to raise any errors
+        list(pool.map(make_venv, deps))
+    # Failures can wait until the build that wants the image
+    concurrent.futures.wait(list(modglobals._prefetches.values()))
+
+
+def run(args):
+    """
+    Runs every variant, args.jobs at a time, prefixing each line of output
+    with the variant it's from. Writes a JSON summary to args.summary, if
+    given ("-" for stdout).
+
+    Returns 0 if every build succeeded, 1 otherwise.
+    """
+    requests = list(variants(args))
+    start = time.monotonic()
+    _prepare(requests, args.jobs)
+
+    out = {'stdout': sys.stdout.buffer, 'stderr': sys.stderr.buffer}
+    sel = selectors.DefaultSelector()
+    pending = list(enumerate(requests))
+    results = [None] * len(requests)
+    running = {}  # index -> [pid, {fd: name}, result bytes, start]
+    partial = {}  # fd -> incomplete line
+
+    while pending or running:
+        while pending and len(running) < args.jobs:
+            index, request = pending.pop(0)
+            pid, pipes = fork_build(request, close=[key.fd for key in sel.get_map().values()])
+            running[index] = [pid, pipes, b'', time.monotonic()]
+            for fd in pipes:
+                sel.register(fd, selectors.EVENT_READ, index)
+
+        for key, _ in sel.select():
+            index, fd = key.data, key.fd
+            job = running[index]
+            name = job[1][fd]
+            data = os.read(fd, 65536)
+            if name == 'result':
+                job[2] += data
+            else:
+                lines = (partial.pop(fd, b'') + data).split(b'\n')
+                if data:
+                    partial[fd] = lines.pop()
+                prefix = f"[{requests[index]['label']}] ".encode('utf-8')
+                for line in lines:
+                    if line:
+                        out[name].write(prefix + line + b'\n')
+                out[name].flush()
+            if not data:
+                sel.unregister(fd)
+                os.close(fd)
+                del job[1][fd]
+                if not job[1]:
+                    result = reap_build(job[0], job[2])
+                    result['seconds'] = time.monotonic() - job[3]
+                    results[index] = result
+                    del running[index]
+
+    summary = {
+        'seconds': time.monotonic() - start,
+        'builds': [
+            {
+                'script': request['script'],
+                'args': dict(kv.split('=', 1) for kv in request['args']),
+                'tags': request['tags'] if result['image'] else [],
+                'pushed': request['push'] if result['image'] else [],
+                'exported': request['export'] if result['image'] else None,
+                'image': result['image'],
+                'status': result['status'],
+                'seconds': result['seconds'],
+            }
+            for request, result in zip(requests, results)
+        ],
+    }
+    failed = [b for b in summary['builds'] if b['status'] != 0]
+    print(
+        f"Built {len(requests) - len(failed)} of {len(requests)} in {summary['seconds']:.1f}s",
+        file=sys.stderr,
+    )
+    for build in failed:
+        print(f"  Failed: {build['script']} {build['args']}", file=sys.stderr)
+
+    if args.summary == '-':
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    elif args.summary:
+        with open(args.summary, 'wt') as fobj:
+            json.dump(summary, fobj, indent=2)
+
+    return 1 if failed else 0
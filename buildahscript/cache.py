@@ -0,0 +1,311 @@
+"""
+Persistent on-disk caches
+"""
+import contextlib
+import dataclasses
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shutil
+import stat
+import threading
+import time
+import typing
+
+
+def cache_root(*parts):
+    """
+    Returns the directory buildahscript keeps its caches in, creating it if
+    needed.
+
+    Honors $BUILDAHSCRIPT_CACHE_DIR, then $XDG_CACHE_HOME.
+    """
+    if os.environ.get('BUILDAHSCRIPT_CACHE_DIR'):
+        base = pathlib.Path(os.environ['BUILDAHSCRIPT_CACHE_DIR'])
+    else:
+        xdg = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+        base = pathlib.Path(xdg) / 'buildahscript'
+    path = base.joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def hash_key(*parts):
+    """
+    Produces a stable hex key from some JSON-able parts.
+    """
+    blob = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def hash_path(path):
+    """
+    Hashes a file or directory tree: names, types, permissions and contents.
+    """
+    digest = hashlib.sha256()
+    _hash_into(digest, str(path), '.', os.stat(path))
+    return digest.hexdigest()
+
+
+def _hash_into(digest, path, relpath, st):
+    digest.update(f"{relpath}\0{st.st_mode:o}\0".encode('utf-8', 'surrogateescape'))
+    if stat.S_ISDIR(st.st_mode):
+        for name in sorted(os.listdir(path)):
+            child = os.path.join(path, name)
+            _hash_into(digest, child, f"{relpath}/{name}", os.lstat(child))
+    elif stat.S_ISLNK(st.st_mode):
+        digest.update(os.fsencode(os.readlink(path)))
+    elif stat.S_ISREG(st.st_mode):
+        with open(path, 'rb') as fobj:
+            for chunk in iter(lambda: fobj.read(1024 * 1024), b''):
+                digest.update(chunk)
+    digest.update(b'\0')
+
+
+SIZE = re.compile(r"(?P<num>\d+(?:\.\d+)?)\s*(?P<unit>[kmgt]?)i?b?", re.IGNORECASE)
+
+
+def parse_size(text):
+    """
+    Parses human sizes like `512M` or `2GiB` into bytes.
+    """
+    match = SIZE.fullmatch(text.strip())
+    if not match:
+        raise ValueError(f"Unable to parse size {text!r}")
+    power = ' kmgt'.index(match.group('unit').lower() or ' ')
+    return int(float(match.group('num')) * 1024 ** power)
+
+
+DURATION = re.compile(r"(?P<num>\d+(?:\.\d+)?)\s*(?P<unit>[smhd]?)", re.IGNORECASE)
+
+
+def parse_duration(text):
+    """
+    Parses durations like `90`, `30m` or `1d` into seconds.
+    """
+    match = DURATION.fullmatch(text.strip())
+    if not match:
+        raise ValueError(f"Unable to parse duration {text!r}")
+    scale = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group('unit').lower()]
+    return float(match.group('num')) * scale
+
+
+def format_size(size):
+    """
+    The inverse of parse_size(), roughly.
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TiB'
+    return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+
+
+def dir_size(path):
+    """
+    Total apparent size of everything under path, counting hardlinks once.
+    """
+    seen = set()
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_size
+    return total
+
+
+@contextlib.contextmanager
+def flock(path, *, shared=False, blocking=True):
+    """
+    Holds an flock() on path (created if missing) for the duration.
+
+    Yields the file descriptor, or None if blocking is false and the lock is
+    held elsewhere.
+    """
+    fd = os.open(str(path), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(fd, mode if blocking else mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield None
+        else:
+            yield fd
+    finally:
+        os.close(fd)
+
+
+@dataclasses.dataclass
+class Entry:
+    key: str
+    path: pathlib.Path
+    size: int
+    last_used: float
+    meta: typing.Dict[str, typing.Any]
+
+
+class Store:
+    """
+    A directory of cache entries, each its own subdirectory, evicted least
+    recently used first.
+
+    Every entry has a lock file beside it. Users hold it shared for as long as
+    they need the entry; populating and evicting hold it exclusively, so
+    entries in use are never evicted out from under a build.
+    """
+
+    def __init__(self, name, *, max_size=None):
+        self.name = name
+        self.max_size = max_size
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.name}>'
+
+    @property
+    def root(self):
+        return cache_root(self.name)
+
+    def path(self, key):
+        return self.root / key
+
+    def _lockfile(self, key):
+        return self.root / f".{key}.lock"
+
+    def _metafile(self, key):
+        return self.root / f".{key}.json"
+
+    def read_meta(self, key):
+        try:
+            with self._metafile(key).open('rt') as fobj:
+                return json.load(fobj)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_meta(self, key, meta):
+        # Threads may write the same key at once, so each has its own
+        tmp = self._metafile(key).with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        with tmp.open('wt') as fobj:
+            json.dump(meta, fobj)
+        os.replace(tmp, self._metafile(key))
+
+    def __contains__(self, key):
+        return self.path(key).is_dir()
+
+    @contextlib.contextmanager
+    def entry(self, key, populate, *, inheritable=False):
+        """
+        Context manager giving the path of the entry for key.
+
+        If the entry does not exist, populate(path) is called to fill in a
+        fresh directory, and may return a dict to save as the entry's
+        metadata. The entry is locked against eviction until the context
+        exits; if inheritable is true, the lock also survives an exec().
+        """
+        path = self.path(key)
+        with flock(self._lockfile(key), shared=True) as fd:
+            if not path.is_dir():
+                # Trade up to an exclusive lock to build it. flock() drops the
+                # shared lock first, so check again once we have it.
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if not path.is_dir():
+                    self._populate(key, populate)
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                if self.max_size is not None:
+                    # Our own entry is locked, so this won't evict it
+                    self.prune(self.max_size)
+            os.utime(path)
+            if inheritable:
+                os.set_inheritable(fd, True)
+            yield path
+
+    def _populate(self, key, populate):
+        tmp = self.root / f".tmp-{key}-{os.getpid()}"
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir()
+        try:
+            meta = populate(tmp) or {}
+            meta['size'] = dir_size(tmp)
+            meta['created'] = time.time()
+            self.write_meta(key, meta)
+            os.rename(tmp, self.path(key))
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def entries(self):
+        """
+        Lists the entries currently in the store, least recently used first.
+        """
+        entries = []
+        for child in self.root.iterdir():
+            if child.name.startswith('.') or not child.is_dir():
+                continue
+            meta = self.read_meta(child.name)
+            # Entries marked mutable change size after they're made, so they're
+            # measured now rather than then
+            size = None if meta.get('mutable') else meta.get('size')
+            if size is None:
+                size = dir_size(child)
+            entries.append(Entry(
+                key=child.name,
+                path=child,
+                size=size,
+                last_used=child.stat().st_mtime,
+                meta=meta,
+            ))
+        entries.sort(key=lambda e: e.last_used)
+        return entries
+
+    def evict(self, key):
+        """
+        Removes an entry, unless it's in use. Returns if it was removed.
+        """
+        with flock(self._lockfile(key), blocking=False) as fd:
+            if fd is None:
+                return False
+            path = self.path(key)
+            if path.is_dir():
+                # Move it aside first so a half-deleted entry never looks valid
+                trash = self.root / f".trash-{key}-{os.getpid()}"
+                os.rename(path, trash)
+                shutil.rmtree(trash, ignore_errors=True)
+            with contextlib.suppress(FileNotFoundError):
+                self._metafile(key).unlink()
+            return True
+
+    def prune(self, max_size=0):
+        """
+        Evicts least recently used entries until the store fits in max_size
+        bytes. Entries in use are skipped.
+
+        Returns the list of evicted entries.
+        """
+        entries = self.entries()
+        total = sum(e.size for e in entries)
+        evicted = []
+        for entry in entries:
+            if total <= max_size:
+                break
+            if self.evict(entry.key):
+                total -= entry.size
+                evicted.append(entry)
+        return evicted
+
+
+def list_stores():
+    """
+    Lists every store that exists on disk.
+    """
+    return [
+        Store(child.name)
+        for child in sorted(cache_root().iterdir())
+        if child.is_dir() and not child.name.startswith('.')
+    ]
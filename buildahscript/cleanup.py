@@ -0,0 +1,216 @@
+"""
+Removes containers and images in the background, and cleans up after builds
+that died before they could
+
+Removals are queued to a worker thread, so a script can carry on while
+buildah deletes storage; they're done in order, so a container is gone before
+the image it came from is removed.
+
+Every container and mount a build makes, and every removal still to do, goes
+in a journal for the process, held locked for as long as the process lives.
+The journal is deleted when the build exits normally. If it's killed instead,
+collect() (run in the background by the next build, or by --gc) finds the
+unlocked journal and removes what was left behind.
+"""
+import atexit
+import collections
+import fcntl
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+from .cache import cache_root, flock
+
+JOURNAL_DIR = '.journal'
+
+_lock = threading.Lock()
+_journal_fd = None
+_journal_path = None
+_owner = None
+_queue = None
+
+
+def _after_fork():
+    # The worker thread didn't come with us, but the journal (and its lock)
+    # did; whatever this fork does goes in its parent's journal
+    global _lock, _queue
+    _lock = threading.Lock()
+    _queue = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _start():
+    """
+    Opens the journal and starts the worker, if that hasn't happened yet.
+    Call with _lock held.
+    """
+    global _journal_fd, _journal_path, _owner, _queue
+    if _journal_fd is None:
+        root = cache_root(JOURNAL_DIR)
+        # Not just the pid: a dead build's journal may still be waiting for
+        # collect() when its pid comes around again
+        name = f"{os.getpid()}-{os.urandom(4).hex()}"
+        _journal_path = root / f"{name}.jsonl"
+        # Locked before it's in place, so collect() can't mistake it for a
+        # dead build's
+        tmp = root / f".{name}.tmp"
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND | os.O_CLOEXEC
+        _journal_fd = os.open(str(tmp), flags, 0o644)
+        fcntl.flock(_journal_fd, fcntl.LOCK_EX)
+        os.rename(tmp, _journal_path)
+        _owner = os.getpid()
+        # Forks inherit this, so they drain their own queues too
+        atexit.register(finish)
+    if _queue is None:
+        _queue = queue.Queue()
+        threading.Thread(target=_work, args=(_queue,), name='cleanup', daemon=True).start()
+        if os.getpid() == _owner:
+            # Tidy up after earlier builds while this one gets going
+            _queue.put((collect, ()))
+
+
+def _record(event, id):
+    """
+    Adds an event to the journal. Call with _lock held.
+    """
+    os.write(_journal_fd, json.dumps([event, id]).encode('utf-8') + b'\n')
+
+
+def _work(jobs):
+    while True:
+        func, args = jobs.get()
+        try:
+            func(*args)
+        except Exception as exc:
+            print(f"Warning: Cleanup failed: {exc}", file=sys.stderr)
+        finally:
+            jobs.task_done()
+
+
+def created(kind, id):
+    """
+    Notes that a container was created, or mounted (kind "container" or
+    "mount"), so it gets cleaned up if the build dies.
+    """
+    with _lock:
+        _start()
+        _record(kind, id)
+
+
+def released(kind, id):
+    """
+    Notes that a container from created() was removed, or unmounted.
+    """
+    with _lock:
+        _start()
+        _record(f"{kind}-done", id)
+
+
+def _remove(kind, id):
+    from .modglobals import _buildah
+
+    if kind == 'container':
+        _buildah('rm', id, stdout=subprocess.DEVNULL)
+    else:
+        _buildah('rmi', id, stdout=subprocess.DEVNULL)
+    with _lock:
+        _record(f"{kind}-done", id)
+
+
+def remove_container(id):
+    """
+    Queues the container for removal (which also unmounts it).
+    """
+    with _lock:
+        _start()
+        _queue.put((_remove, ('container', id)))
+
+
+def remove_image(id):
+    """
+    Queues the image for removal, after any containers already queued.
+    """
+    with _lock:
+        _start()
+        _record('image', id)
+        _queue.put((_remove, ('image', id)))
+
+
+def drain():
+    """
+    Waits for every queued removal to finish.
+    """
+    jobs = _queue
+    if jobs is not None:
+        jobs.join()
+
+
+def finish():
+    """
+    Waits for every queued removal, then closes the journal if it's ours.
+    Runs at exit.
+    """
+    global _journal_fd
+    drain()
+    if os.getpid() == _owner:
+        # Anything still around was left on purpose
+        with _lock:
+            if _journal_fd is not None:
+                os.unlink(_journal_path)
+                os.close(_journal_fd)
+                _journal_fd = None
+
+
+def _outstanding(path):
+    """
+    Replays a journal, giving what it says still needs cleaning up, as
+    {kind: [id, ...]}.
+    """
+    pending = collections.defaultdict(dict)
+    with open(path, 'rt') as fobj:
+        for line in fobj:
+            try:
+                event, id = json.loads(line)
+            except ValueError:
+                # Cut off mid-write
+                continue
+            if event.endswith('-done'):
+                pending[event[:-len('-done')]].pop(id, None)
+                if event == 'container-done':
+                    # Removing it unmounted it
+                    pending['mount'].pop(id, None)
+            else:
+                pending[event][id] = None
+    return {kind: list(ids) for kind, ids in pending.items() if ids}
+
+
+def collect():
+    """
+    Removes the mounts, containers and images left behind by builds that
+    died. Returns how many of each were removed, as {kind: count}.
+    """
+    from .modglobals import _buildah
+
+    removed = collections.Counter()
+    for path in sorted(cache_root(JOURNAL_DIR).glob('*.jsonl')):
+        if path == _journal_path:
+            continue
+        with flock(path, blocking=False) as fd:
+            if fd is None:
+                # Still running
+                continue
+            pending = _outstanding(path)
+            for kind, cmd in (('mount', 'umount'), ('container', 'rm'), ('image', 'rmi')):
+                for id in pending.get(kind, ()):
+                    proc = _buildah(
+                        cmd, id, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    )
+                    if proc.returncode == 0:
+                        removed[kind] += 1
+            path.unlink()
+    return dict(removed)
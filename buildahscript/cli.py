@@ -1,23 +1,109 @@
 import argparse
+import marshal
 import os
 import shutil
 import sys
 
-from .metadata import Metadata
-from .venv import make_tmp_venv
-from .runner import parse_buildargs, run_file
+from . import trace
+from .cache import Store, format_size, list_stores, parse_duration, parse_size
+from .runner import load_script, parse_buildargs, run_file
+
+# Carries the loaded script and build args across the buildah unshare re-exec
+HANDOFF_VAR = 'BUILDAHSCRIPT_HANDOFF'
+
+
+def _pull_policy(text):
+    from . import modglobals
+
+    if text in (modglobals.PULL_NEVER, modglobals.PULL_MISSING, modglobals.PULL_ALWAYS):
+        return text
+    else:
+        return parse_duration(text)
+
 
 parser = argparse.ArgumentParser(description='Run a script to build a container')
-parser.add_argument('script', metavar='FILE',
-                    help='File to run')
+parser.add_argument('scripts', metavar='FILE', nargs='*',
+                    help='File to run; more than one runs them all as a batch')
 parser.add_argument('--build-arg', metavar="NAME=VALUE", dest='args', action='append',
                     help='Specify a build argument')
 parser.add_argument('--tag', '-t', metavar="NAME", dest='tags', action='append',
-                    help='tag to apply to the resulting image')
+                    help='tag to apply to the resulting image; in a batch, {arg} and '
+                         '{script} are filled in')
+parser.add_argument('--push', metavar='DEST', action='append',
+                    help='push the resulting image to DEST (eg docker://registry/name:tag, '
+                         'oci:/path), filled in like --tag; give more than once to push to '
+                         'several at once')
+parser.add_argument('--export', metavar='PATH',
+                    help='write the resulting image to PATH, filled in like --tag; ending it '
+                         'in .gz or .zst compresses the whole archive, on every core')
+parser.add_argument('--export-format', default='oci-archive',
+                    choices=['oci-archive', 'docker-archive', 'oci-dir'],
+                    help='with --export, the format to write (default oci-archive)')
+parser.add_argument('--compression', metavar='FORMAT', choices=['gzip', 'zstd', 'zstd:chunked'],
+                    help='with --push or --export, compress layers as gzip, zstd or zstd:chunked')
+parser.add_argument('--compression-level', metavar='N', type=int,
+                    help='with --push or --export, the compression level')
+parser.add_argument('--pull', metavar='POLICY', type=_pull_policy,
+                    help='when to pull images: never, missing (the default), always, '
+                         'or if not pulled within a duration (eg 12h)')
+parser.add_argument('--layer-cache', action='store_true',
+                    help='reuse the results of unchanged steps from previous builds')
+parser.add_argument('--analyze', action='store_true',
+                    help="report the image's size, and what each step adds to it")
+parser.add_argument('--profile', action='store_true',
+                    help='print a summary of where the build spent its time')
+parser.add_argument('--trace', metavar='FILE',
+                    help='write a Chrome/Perfetto trace of the build to FILE')
+parser.add_argument('--cache-list', action='store_true',
+                    help='list the contents of the caches and exit')
+parser.add_argument('--cache-prune', metavar='NAME',
+                    help='evict unused entries from the named cache (or "all"), or just '
+                         'one, as CACHE/ENTRY (eg mounts/cargo), and exit')
+parser.add_argument('--cache-max-size', metavar='SIZE', type=parse_size, default=0,
+                    help='with --cache-prune, only evict down to this size (eg 1G)')
+parser.add_argument('--gc', action='store_true',
+                    help='remove containers, mounts and images left behind by builds that '
+                         'were killed, and exit')
+parser.add_argument('--watch', action='store_true',
+                    help='rebuild whenever a file the build read changes, until interrupted')
+parser.add_argument('--daemon', metavar='SOCKET',
+                    help='run as a build server listening on the Unix socket SOCKET')
+parser.add_argument('--connect', metavar='SOCKET',
+                    help='run the build on the build server at SOCKET')
+parser.add_argument('--jobs', '-j', metavar='N', type=int, default=4,
+                    help='how many builds to run at once (default 4)')
+parser.add_argument('--matrix', metavar='FILE',
+                    help='build every combination of the build args in this JSON file')
+parser.add_argument('--summary', metavar='FILE',
+                    help='in a batch, write a JSON summary of the builds to FILE (- for stdout)')
 
 
 def main():
     args = parser.parse_args()
+    args.batch = len(args.scripts) > 1 or args.matrix is not None
+    args.script = args.scripts[0] if len(args.scripts) == 1 else None
+    if args.cache_list or args.cache_prune:
+        return main_cache(args)
+    elif not args.scripts and args.daemon is None and not args.gc:
+        parser.error('a script to run is required')
+    elif args.watch and (args.batch or args.connect or args.daemon):
+        parser.error('--watch runs one script, locally')
+    elif args.connect:
+        if args.batch:
+            parser.error('--connect only runs one script at a time')
+        return main_connect(args)
+    elif args.batch:
+        from . import batch
+
+        # Before going to the trouble of a re-exec
+        try:
+            batch.check(args)
+        except ValueError as exc:
+            parser.error(str(exc))
+
+    if args.profile or args.trace:
+        trace.enable()
+
     if '_CONTAINERS_USERNS_CONFIGURED' in os.environ:
         return main_inner(args)
     else:
@@ -33,20 +119,133 @@ def main_outer(args):
     # https://github.com/containers/buildah/issues/1754
     _fix_path()
 
-    with open(args.script, 'rt') as script:
-        md = Metadata.from_line_iter(script)
+    if args.daemon or args.batch or args.gc or args.watch:
+        # Everything else happens once we're in
+        trace.hand_off()
+        os.execvp('buildah', ['buildah', 'unshare', *sys.argv])
+
+    script = load_script(args.script)
+    md = script.metadata
+    # Also catches bad build args before going to the trouble of a venv
+    buildargs = _buildargs(args, md)
 
     if md.deps:
-        with make_tmp_venv(md.deps) as venv:
+        from .venv import cached_venv
+
+        with cached_venv(md.deps) as venv:
             my_path = sys.path
             inner_path = venv.python_path()
             # This feels bad, but careful thought seems like it'll be fine?
             os.environ['PYTHONPATH'] = os.pathsep.join(inner_path + my_path)
+            _hand_off(args, script, buildargs)
             os.execvp('buildah', ['buildah', 'unshare', *sys.argv])
     else:
+        _hand_off(args, script, buildargs)
         os.execvp('buildah', ['buildah', 'unshare', *sys.argv])
 
 
+def _hand_off(args, script, buildargs):
+    """
+    Pass what we've worked out on to the process we're about to exec, so it
+    doesn't have to do it all again.
+    """
+    filename = os.path.abspath(args.script)
+    try:
+        data = marshal.dumps((filename, script.key, buildargs))
+    except ValueError:
+        # A cast gave something marshal can't handle; the inner process will
+        # just have to parse them again
+        data = marshal.dumps((filename, script.key, None))
+    os.environ[HANDOFF_VAR] = data.hex()
+    trace.hand_off()
+
+
+def _handed_off(args):
+    """
+    Picks up the script and build args from _hand_off(), if they match.
+    """
+    data = os.environ.pop(HANDOFF_VAR, None)
+    if data is None:
+        return None, None
+    try:
+        filename, key, buildargs = marshal.loads(bytes.fromhex(data))
+    except (ValueError, EOFError, TypeError):
+        return None, None
+    if filename != os.path.abspath(args.script):
+        return None, None
+    return load_script(args.script, key=key), buildargs
+
+
+def main_connect(args):
+    """
+    Hand the build off to a build server.
+    """
+    from . import daemon
+
+    result = daemon.submit(args.connect, {
+        'script': os.path.abspath(args.script),
+        'args': args.args,
+        'tags': args.tags,
+        'push': args.push,
+        'export': args.export and os.path.abspath(args.export),
+        'export_format': args.export_format,
+        'compression': args.compression,
+        'compression_level': args.compression_level,
+        'layer_cache': args.layer_cache,
+        'analyze': args.analyze,
+        'pull': args.pull,
+        'cwd': os.getcwd(),
+    })
+    return result['status']
+
+
+def main_cache(args):
+    """
+    Inspect or prune the on-disk caches.
+    """
+    if args.cache_prune and '/' in args.cache_prune:
+        name, key = args.cache_prune.split('/', 1)
+        store = Store(name)
+        if key not in store:
+            print(f"{name}: no entry {key}", file=sys.stderr)
+            return 1
+        elif not store.evict(key):
+            print(f"{name}: {key} is in use", file=sys.stderr)
+            return 1
+        print(f"{name}: evicted {key}")
+        return 0
+
+    if args.cache_prune in (None, 'all'):
+        stores = list_stores()
+    else:
+        stores = [Store(args.cache_prune)]
+
+    for store in stores:
+        if args.cache_prune:
+            evicted = store.prune(args.cache_max_size)
+            freed = sum(e.size for e in evicted)
+            print(f"{store.name}: evicted {len(evicted)} entries, freed {format_size(freed)}")
+        else:
+            entries = store.entries()
+            total = sum(e.size for e in entries)
+            print(f"{store.name}: {len(entries)} entries, {format_size(total)}")
+            for entry in reversed(entries):
+                print(f"  {entry.key[:16]:<16}  {format_size(entry.size):>9}  {entry.meta.get('description', '')}")
+
+
+def main_gc():
+    """
+    Clean up after builds that were killed partway.
+    """
+    from . import cleanup
+
+    removed = cleanup.collect()
+    print(
+        f"Unmounted {removed.get('mount', 0)} mounts, removed {removed.get('container', 0)} "
+        f"containers and {removed.get('image', 0)} images"
+    )
+
+
 def _fix_path():
     if shutil.which('runc') is None:
         for path in ('/sbin', '/usr/sbin', '/usr/local/sbin'):
@@ -63,10 +262,32 @@ def main_inner(args):
     """
     We're running inside the buildah unshare environment, actually do the build.
     """
-    # Parse buildargs
-    with open(args.script, 'rt') as script:
-        md = Metadata.from_line_iter(script)
+    from . import cleanup
+
+    if args.daemon:
+        from . import daemon
+        return daemon.serve(args.daemon, jobs=args.jobs)
+    elif args.gc:
+        return main_gc()
+
+    try:
+        if args.batch:
+            from . import batch
+            return batch.run(args)
+        elif args.watch:
+            from . import watch
+            return watch.run(args)
+        _build(args)
+    finally:
+        # Let the last removals show up in the trace
+        cleanup.drain()
+        if args.trace:
+            trace.write_chrome_trace(args.trace)
+        if args.profile:
+            trace.print_summary()
+
 
+def _buildargs(args, md):
     if args.args:
         # TODO: Better error message if an arg doesn't have a '='
         rawargs = dict(
@@ -75,18 +296,47 @@ def main_inner(args):
         )
     else:
         rawargs = {}
-    buildargs = parse_buildargs(md.args, rawargs)
+    return parse_buildargs(md.args, rawargs)
+
+
+def _build(args):
+    from . import modglobals
+
+    script, buildargs = _handed_off(args)
+    if script is None:
+        script = load_script(args.script)
+    if buildargs is None:
+        buildargs = _buildargs(args, script.metadata)
+
+    if args.layer_cache:
+        modglobals.Container.use_cache = True
+    if args.analyze:
+        modglobals.Container.analyze_steps = True
+    if args.pull is not None:
+        modglobals.Image.pull_policy = args.pull
 
     # Run the script
-    img = run_file(args.script, buildargs)
+    img = run_file(args.script, buildargs, script=script)
 
     # Do some things if the script returned an image
     if img is not None:
         if args.tags:
-            for tag in args.tags:
-                img.add_tag(tag)
+            img.add_tag(*args.tags)
+        if args.push:
+            results = img.push(
+                *args.push, compression=args.compression, level=args.compression_level,
+            )
+            for result in results:
+                print(f"Pushed {result}", file=sys.stderr)
+        if args.export:
+            size = img.export(
+                args.export, args.export_format,
+                compression=args.compression, level=args.compression_level,
+            )
+            print(f"Exported to {args.export} ({format_size(size)})", file=sys.stderr)
         print('')
         print(img)
     else:
-        if args.tags:
-            print("Warning: No image to tag", file=sys.stderr)
+        if args.tags or args.push or args.export:
+            print("Warning: No image to tag, push or export", file=sys.stderr)
+    return img
@@ -0,0 +1,336 @@
+"""
+A long-running build server, so builds skip the cold start
+
+The daemon runs inside buildah unshare and listens on a Unix socket. Each
+connection sends one build request as a line of JSON, and gets back lines of
+JSON: {"stdout": text} and {"stderr": text} as the build logs, then
+{"status": int, "image": id or null, "seconds": float} at the end.
+
+Each build runs in a fork of the daemon, so it starts with everything
+already imported, the image index loaded, and the script already compiled,
+but can't disturb the daemon or other builds.
+"""
+import argparse
+import codecs
+import collections
+import contextlib
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from .runner import load_script
+
+
+class _Build:
+    """
+    A build request, and its forked child once it's running
+    """
+
+    def __init__(self, conn, request):
+        self.conn = conn
+        self.request = request
+        self.pid = None
+        self.pipes = {}  # fd -> 'stdout'/'stderr'/'result'
+        self.result = b''
+        self.started = None
+        self.hung_up = False
+
+
+def serve(path, *, jobs=4):
+    """
+    Listens on the Unix socket at path, running up to jobs builds at once.
+    Runs until interrupted.
+    """
+    from . import modglobals
+
+    # Warm up the things every build needs
+    modglobals._images.load()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    listener.listen()
+    listener.setblocking(False)
+    print(f"Listening on {path}, running up to {jobs} builds at once", file=sys.stderr)
+
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ, 'accept')
+    buffers = {}  # conn -> bytes of the request so far
+    queue = collections.deque()
+    running = {}  # conn -> _Build
+
+    def finish(build):
+        result = reap_build(build.pid, build.result)
+        result['seconds'] = time.monotonic() - build.started
+        _send(build.conn, result)
+        print(
+            f"Finished {build.request['script']} (pid {build.pid}) with status "
+            f"{result['status']} in {result['seconds']:.1f}s",
+            file=sys.stderr,
+        )
+        if not build.hung_up:
+            sel.unregister(build.conn)
+        build.conn.close()
+        del running[build.conn]
+
+    def start(build):
+        try:
+            # Compiled here, so errors show up without a fork, and so the
+            # next request for it is already warm
+            load_script(build.request['script'])
+        except Exception:
+            _send(build.conn, {'stderr': traceback.format_exc()})
+            _send(build.conn, {'status': 1, 'image': None, 'seconds': 0})
+            if not build.hung_up:
+                sel.unregister(build.conn)
+            build.conn.close()
+            return
+        build.started = time.monotonic()
+        # Don't let it hang on to anyone else's sockets or pipes
+        build.pid, build.pipes = fork_build(
+            build.request, close=[key.fileobj for key in sel.get_map().values()],
+        )
+        running[build.conn] = build
+        for read in build.pipes:
+            sel.register(read, selectors.EVENT_READ, ('pipe', build))
+        print(f"Started {build.request['script']} (pid {build.pid})", file=sys.stderr)
+
+    decoders = {}  # fd -> incremental decoder
+
+    # Clean up on a plain kill, too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            while queue and len(running) < jobs:
+                start(queue.popleft())
+            for key, _ in sel.select():
+                if key.data == 'accept':
+                    conn, _ = listener.accept()
+                    buffers[conn] = b''
+                    sel.register(conn, selectors.EVENT_READ, 'request')
+                elif key.data == 'request':
+                    conn = key.fileobj
+                    data = conn.recv(65536)
+                    if not data:
+                        sel.unregister(conn)
+                        conn.close()
+                        buffers.pop(conn, None)
+                        continue
+                    buffers[conn] += data
+                    if b'\n' in buffers[conn]:
+                        line = buffers.pop(conn).split(b'\n', 1)[0]
+                        try:
+                            request = json.loads(line)
+                        except ValueError:
+                            _send(conn, {'stderr': "Malformed request\n"})
+                            _send(conn, {'status': 1, 'image': None, 'seconds': 0})
+                            sel.unregister(conn)
+                            conn.close()
+                            continue
+                        build = _Build(conn, request)
+                        # Only listening for hanging up now
+                        sel.modify(conn, selectors.EVENT_READ, ('client', build))
+                        queue.append(build)
+                        if len(running) >= jobs:
+                            _send(conn, {'stderr': "Waiting for a free build slot\n"})
+                elif key.data[0] == 'client':
+                    build = key.data[1]
+                    if not build.conn.recv(65536):
+                        # The client went away; so can the build
+                        sel.unregister(build.conn)
+                        build.hung_up = True
+                        if build.pid is not None:
+                            os.kill(build.pid, signal.SIGTERM)
+                        else:
+                            queue.remove(build)
+                            build.conn.close()
+                else:
+                    build, fd = key.data[1], key.fd
+                    data = os.read(fd, 65536)
+                    name = build.pipes[fd]
+                    if name == 'result':
+                        build.result += data
+                    elif data or fd in decoders:
+                        if fd not in decoders:
+                            decoders[fd] = codecs.getincrementaldecoder('utf-8')('replace')
+                        text = decoders[fd].decode(data, final=not data)
+                        if text:
+                            _send(build.conn, {name: text})
+                    if not data:
+                        sel.unregister(fd)
+                        os.close(fd)
+                        decoders.pop(fd, None)
+                        del build.pipes[fd]
+                        if not build.pipes:
+                            finish(build)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for build in running.values():
+            os.kill(build.pid, signal.SIGTERM)
+        listener.close()
+        os.unlink(path)
+
+
+def _send(conn, message):
+    try:
+        conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+    except OSError:
+        # The client's gone; the build carries on regardless
+        pass
+
+
+def fork_build(request, *, close=(), capture=True):
+    """
+    Starts a build request in a fork of this process, which must be inside
+    buildah unshare. close is sockets or fds the fork shouldn't keep open.
+
+    Returns the child's pid and its pipes, {fd: name}: its "stdout" and
+    "stderr" (unless capture is false, in which case it shares ours), and a
+    "result" to read to the end and give to reap_build().
+    """
+    names = ('stdout', 'stderr', 'result') if capture else ('result',)
+    fds = {name: os.pipe() for name in names}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        for obj in close:
+            if isinstance(obj, socket.socket):
+                obj.close()
+            else:
+                os.close(obj)
+        for read, _ in fds.values():
+            os.close(read)
+        if capture:
+            os.dup2(fds['stdout'][1], 1)
+            os.dup2(fds['stderr'][1], 2)
+        _child(request, fds['result'][1])
+    pipes = {}
+    for name, (read, write) in fds.items():
+        os.close(write)
+        pipes[read] = name
+    return pid, pipes
+
+
+def reap_build(pid, result):
+    """
+    Waits for a build started by fork_build() to exit, and returns its result
+    as a dict with the status, the image, and the host paths it read from
+    ("inputs").
+    """
+    from . import modglobals
+
+    _, status = os.waitpid(pid, 0)
+    try:
+        result = json.loads(result)
+    except ValueError:
+        result = {'image': None, 'inputs': []}
+    # Keep our index up to date with whatever the build did
+    modglobals._images.replay(result.pop('index', []))
+    # If it had to reload, so do we, rather than every build after it
+    modglobals._images.load()
+    result['status'] = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return result
+
+
+def _child(request, result_fd):
+    """
+    Runs a build in a fork. Never returns.
+    """
+    from . import cleanup, cli, modglobals
+
+    status = 1
+    result = {'image': None}
+    modglobals._images.changes = []
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.chdir(request.get('cwd') or '/')
+        args = argparse.Namespace(
+            script=request['script'],
+            args=request.get('args'),
+            tags=request.get('tags'),
+            push=request.get('push'),
+            export=request.get('export'),
+            export_format=request.get('export_format', 'oci-archive'),
+            compression=request.get('compression'),
+            compression_level=request.get('compression_level'),
+            layer_cache=request.get('layer_cache', False),
+            analyze=request.get('analyze', False),
+            pull=request.get('pull'),
+        )
+        with contextlib.ExitStack() as stack:
+            deps = load_script(args.script).metadata.deps
+            if deps:
+                from .venv import cached_venv
+
+                # Like the PYTHONPATH a plain run would get
+                venv = stack.enter_context(cached_venv(deps))
+                sys.path[:0] = [p for p in venv.python_path() if p not in sys.path]
+            img = cli._build(args)
+        result['image'] = None if img is None else str(img)
+        status = 0
+    except SystemExit as exc:
+        status = exc.code if isinstance(exc.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        result['index'] = modglobals._images.changes
+        result['inputs'] = _inputs(request['script'])
+        try:
+            # os._exit() skips atexit, which would otherwise do this
+            cleanup.finish()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            with os.fdopen(result_fd, 'wb') as fobj:
+                fobj.write(json.dumps(result).encode('utf-8'))
+        finally:
+            os._exit(status)
+
+
+def _inputs(script):
+    """
+    Everything on the host the build read: what it copied in, the script,
+    and modules imported from beside it.
+    """
+    from . import modglobals
+
+    script = os.path.abspath(script)
+    here = os.path.dirname(script) + os.sep
+    modules = {
+        module.__file__ for module in list(sys.modules.values())
+        if (getattr(module, '__file__', None) or '').startswith(here)
+    }
+    return sorted(modglobals._inputs | modules | {script})
+
+
+def submit(path, request):
+    """
+    Sends a build to the daemon at path, copying its logs to our stdout and
+    stderr. Returns the result message.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with conn.makefile('rb') as responses:
+            for line in responses:
+                message = json.loads(line)
+                if 'stdout' in message:
+                    sys.stdout.write(message['stdout'])
+                    sys.stdout.flush()
+                elif 'stderr' in message:
+                    sys.stderr.write(message['stderr'])
+                    sys.stderr.flush()
+                elif 'status' in message:
+                    return message
+    raise ConnectionError(f"The daemon at {path} hung up without a result")
@@ -0,0 +1,219 @@
+"""
+Cached, parallel downloads
+"""
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import urllib.error
+import urllib.request
+
+from .cache import Store, cache_root, hash_key
+
+#: Downloaded files, by the sha256 of their contents. Capped at 5GiB by default.
+DOWNLOAD_STORE = Store('downloads', max_size=5 * 1024 ** 3)
+
+#: Files at least this big are fetched in parallel pieces, if the server allows
+PARALLEL_THRESHOLD = 32 * 1024 * 1024
+#: The size of each piece
+CHUNK_SIZE = 8 * 1024 * 1024
+#: How many pieces to fetch at once
+MAX_CONNECTIONS = 8
+
+
+class ChecksumMismatchError(Exception):
+    """
+    A download didn't have the expected checksum
+    """
+
+
+def _url_record(url):
+    return cache_root('download-urls') / f"{hash_key(url)}.json"
+
+
+def _read_record(url):
+    try:
+        with _url_record(url).open('rt') as fobj:
+            return json.load(fobj)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_record(url, record):
+    path = _url_record(url)
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    with tmp.open('wt') as fobj:
+        json.dump(record, fobj)
+    os.replace(tmp, path)
+
+
+class _Evicted(Exception):
+    """
+    A cache entry we were counting on went away
+    """
+
+
+def _evicted(entry):
+    # populate() for entries that should already be there
+    raise _Evicted(entry)
+
+
+@contextlib.contextmanager
+def fetch(url, *, sha256=None):
+    """
+    Downloads url into the download cache. Context manager, giving the path of
+    the cached file, which must not be modified.
+
+    Previously downloaded URLs are revalidated with the server (ETag and
+    Last-Modified). If the expected sha256 is given, a cached copy is used
+    without touching the network at all, and a download that doesn't match
+    it raises ChecksumMismatchError.
+    """
+    if sha256 is not None:
+        sha256 = sha256.lower()
+        if sha256 in DOWNLOAD_STORE:
+            with contextlib.ExitStack() as stack:
+                try:
+                    path = stack.enter_context(DOWNLOAD_STORE.entry(sha256, _evicted))
+                except _Evicted:
+                    # Evicted since we looked; download it after all
+                    pass
+                else:
+                    yield path / 'blob'
+                    return
+
+    record = _read_record(url)
+    request = urllib.request.Request(url)
+    if record and record['sha256'] in DOWNLOAD_STORE:
+        if record.get('etag'):
+            request.add_header('If-None-Match', record['etag'])
+        if record.get('last_modified'):
+            request.add_header('If-Modified-Since', record['last_modified'])
+
+    # Unique to the call, since threads may be fetching the same URL
+    tmp = DOWNLOAD_STORE.root / f".download-{hash_key(url)}-{os.getpid()}-{os.urandom(4).hex()}"
+    try:
+        try:
+            record, digest = _get(url, request, tmp)
+        except urllib.error.HTTPError as exc:
+            if exc.code != 304:
+                raise
+            digest = record['sha256']
+
+        def check(digest):
+            if sha256 is not None and digest != sha256:
+                raise ChecksumMismatchError(f"{url} has sha256 {digest}, expected {sha256}")
+
+        def populate(entry):
+            if not tmp.exists():
+                # Only revalidated, so there's nothing to put in it
+                raise _Evicted(entry)
+            os.rename(tmp, entry / 'blob')
+            return {'url': url, 'description': url}
+
+        check(digest)
+        with contextlib.ExitStack() as stack:
+            try:
+                path = stack.enter_context(DOWNLOAD_STORE.entry(digest, populate))
+            except _Evicted:
+                # Evicted between asking the server and using it; start over
+                record, digest = _get(url, urllib.request.Request(url), tmp)
+                check(digest)
+                path = stack.enter_context(DOWNLOAD_STORE.entry(digest, populate))
+            record['sha256'] = digest
+            _write_record(url, record)
+            yield path / 'blob'
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            tmp.unlink()
+
+
+def _get(url, request, dest):
+    """
+    Makes the request, saving the body to dest. Returns the URL's new record
+    and the body's sha256.
+    """
+    with urllib.request.urlopen(request) as resp:
+        record = {
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+        }
+        return record, _download(url, resp, dest)
+
+
+def _download(url, resp, dest):
+    """
+    Saves the body of resp to dest, returning its sha256.
+
+    Large bodies are fetched again as several ranges at once, if the server
+    supports it.
+    """
+    length = resp.headers.get('Content-Length')
+    if (
+        length is not None and int(length) >= PARALLEL_THRESHOLD
+        and resp.headers.get('Accept-Ranges') == 'bytes'
+    ):
+        # Can't make use of this one, we're starting over in pieces
+        resp.close()
+        validator = resp.headers.get('ETag')
+        if not validator or validator.startswith('W/'):
+            # If-Range only takes strong validators
+            validator = resp.headers.get('Last-Modified')
+        try:
+            _download_ranges(url, int(length), validator, dest)
+        except _RangeNotSatisfied:
+            pass
+        else:
+            return _hash_file(dest)
+        resp = urllib.request.urlopen(url)
+
+    digest = hashlib.sha256()
+    with resp, open(dest, 'wb') as fobj:
+        for chunk in iter(lambda: resp.read(1024 * 1024), b''):
+            digest.update(chunk)
+            fobj.write(chunk)
+    return digest.hexdigest()
+
+
+class _RangeNotSatisfied(Exception):
+    """
+    The server didn't give us the range we asked for
+    """
+
+
+def _download_ranges(url, length, validator, dest):
+    """
+    Fetch url into dest as several Range requests at once.
+    """
+    with open(dest, 'wb') as fobj:
+        fobj.truncate(length)
+        fd = fobj.fileno()
+
+        def fetch_range(start):
+            end = min(start + CHUNK_SIZE, length) - 1
+            request = urllib.request.Request(url, headers={'Range': f"bytes={start}-{end}"})
+            if validator:
+                # If it changed under us, we get a 200 instead
+                request.add_header('If-Range', validator)
+            with urllib.request.urlopen(request) as resp:
+                if resp.status != 206:
+                    raise _RangeNotSatisfied(url)
+                offset = start
+                for chunk in iter(lambda: resp.read(1024 * 1024), b''):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+                if offset != end + 1:
+                    raise _RangeNotSatisfied(url)
+
+        with concurrent.futures.ThreadPoolExecutor(MAX_CONNECTIONS) as pool:
+            # list() to raise any errors
+            list(pool.map(fetch_range, range(0, length, CHUNK_SIZE)))
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
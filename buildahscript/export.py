@@ -0,0 +1,88 @@
+"""
+Compresses image archives as they're written, on every core
+"""
+import collections
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import zlib
+
+#: How much each gzip thread compresses at once
+BLOCK_SIZE = 1024 * 1024
+
+#: Archive file endings, and how they're compressed
+SUFFIXES = {
+    '.gz': 'gzip',
+    '.tgz': 'gzip',
+    '.zst': 'zstd',
+    '.tzst': 'zstd',
+}
+
+
+def archive_compression(path):
+    """
+    How the archive at path should be compressed, going by its name, or None.
+    """
+    for suffix, compression in SUFFIXES.items():
+        if str(path).endswith(suffix):
+            return compression
+    return None
+
+
+def _gzip_block(data, level):
+    # Each block is a gzip member of its own; gzip readers carry on from one
+    # member to the next as if it were one stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def parallel_gzip(src, dst, *, level=6, jobs=None):
+    """
+    Gzips the file object src into the file object dst, with jobs threads
+    compressing blocks at once (zlib lets go of the GIL while it works).
+    Only a few blocks per thread are held in memory at a time.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+            pending.append(pool.submit(_gzip_block, block, level))
+            if len(pending) >= jobs * 2:
+                dst.write(pending.popleft().result())
+        while pending:
+            dst.write(pending.popleft().result())
+
+
+def parallel_zstd(src, dst, *, level=None, jobs=None):
+    """
+    Compresses the file object src into the file object dst with the zstd
+    command line tool's own threads.
+    """
+    if shutil.which('zstd') is None:
+        raise RuntimeError("zstd compression needs the zstd command installed")
+    cmd = ['zstd', '-q', '-c', f"-T{jobs or 0}"]
+    if level is not None:
+        cmd += [f"-{level}"]
+        if level > 19:
+            cmd += ['--ultra']
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=dst)
+    try:
+        shutil.copyfileobj(src, proc.stdin, BLOCK_SIZE)
+    finally:
+        proc.stdin.close()
+        status = proc.wait()
+    if status != 0:
+        raise subprocess.CalledProcessError(status, cmd)
+
+
+def compress(src, dst, compression, *, level=None, jobs=None):
+    """
+    Compresses the file object src into dst, as "gzip" or "zstd".
+    """
+    if compression == 'gzip':
+        parallel_gzip(src, dst, level=6 if level is None else level, jobs=jobs)
+    elif compression == 'zstd':
+        parallel_zstd(src, dst, level=level, jobs=jobs)
+    else:
+        raise ValueError(f"Unknown compression {compression!r}")
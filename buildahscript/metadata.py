@@ -72,8 +72,15 @@ class Metadata:
         Parses out metadata from an iterable of lines (including file objects
         opened in readable text mode).
         """
+        return cls.from_pairs(scan_metadata_lines(lines))
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        Builds metadata from the (prefix, text) pairs of scan_metadata_lines()
+        """
         self = cls()
-        for type, data in scan_metadata_lines(lines):
+        for type, data in pairs:
             if type == 'pip':
                 self.deps.append(data)
             elif type == 'arg':
@@ -3,21 +3,47 @@ Global functions for the module
 """
 import contextlib
 import copy
+import dataclasses
+import functools
+import hashlib
 import json
+import os
 import pathlib
-import shutil
 import subprocess
-import urllib.request
+import sys
+import threading
+import time
+import types
 import typing
 
+from . import cleanup, trace
+from .cache import (
+    Store, cache_root, dir_size, flock, format_size, hash_key, hash_path,
+)
+
+# Most scripts never download or copy anything, so those modules (and what
+# they pull in, like urllib and thread pools) are imported where they're used.
+
 # This is mandatory
-__all__ = ('__return__', 'Container', 'Image', 'ImageNotFoundError')
+__all__ = (
+    '__return__', 'Container', 'Image', 'ImageNotFoundError', 'background',
+    'cached_stage', 'parallel',
+)
 
 
 def _buildah(*cmd, **opts):
     opts.setdefault('stdout', subprocess.PIPE)
     opts.setdefault('check', True)
-    return subprocess.run(['buildah', *cmd], encoding='utf-8', **opts)
+    with trace.span(f"buildah {cmd[0]}", 'buildah', cmd=['buildah', *cmd]) as info:
+        try:
+            proc = subprocess.run(['buildah', *cmd], encoding='utf-8', **opts)
+        except subprocess.CalledProcessError as exc:
+            info['status'] = exc.returncode
+            raise
+        info['status'] = proc.returncode
+        if isinstance(proc.stdout, str):
+            info['stdout_bytes'] = len(proc.stdout.encode('utf-8'))
+        return proc
 
 # build-using-dockerfile Build an image using instructions in a Dockerfile
 
@@ -28,7 +54,6 @@ def _buildah(*cmd, **opts):
 # containers             List working containers and their base images
 # rename                 Rename a container
 # pull                   Pull an image from the specified location
-# push                   Push an image to a specified destination
 # login                  Login to a container registry
 # logout                 Logout of a container registry
 
@@ -60,9 +85,136 @@ def _join_shellwords(seq):
     return " ".join(f"'{s}'" for s in seq)
 
 
+#: Host paths the build has read from, for --watch
+_inputs = set()
+
+
+def _note_input(path):
+    """
+    Notes that the build read the host file or directory at path
+    """
+    _inputs.add(os.path.abspath(path))
+
+
+#: Where cache mounts live between builds. Capped at 10GiB by default.
+CACHE_MOUNT_STORE = Store('mounts', max_size=10 * 1024 ** 3)
+#: How often, in seconds, builds check cache mounts against that cap
+CACHE_MOUNT_PRUNE_INTERVAL = 60 * 60
+
+
+def _cache_specs(caches):
+    """
+    Normalizes run()'s caches to a sorted list of (name, target, sharing)
+    """
+    specs = []
+    for name, spec in (caches or {}).items():
+        if isinstance(spec, (str, os.PathLike)):
+            target, sharing = spec, 'shared'
+        else:
+            target, sharing = spec
+        if not name or name.startswith('.') or not all(c.isalnum() or c in '-_.' for c in name):
+            raise ValueError(f"Cache names are letters, digits, - _ and ., not {name!r}")
+        if sharing not in ('shared', 'locked'):
+            raise ValueError(f"Cache sharing is 'shared' or 'locked', not {sharing!r}")
+        specs.append((name, str(target), sharing))
+    return sorted(specs)
+
+
+@contextlib.contextmanager
+def _cache_mounts(caches):
+    """
+    Cache mounts for run(), like BuildKit's RUN --mount=type=cache. caches
+    maps a name to where in the container to mount it, or to a (path,
+    sharing) tuple:
+
+    * shared: Any number of runs can use it at once (the default)
+    * locked: Only one run at a time; others wait their turn
+
+    Caches are directories in the mounts store, kept between builds. They
+    can't be evicted while in use. Every CACHE_MOUNT_PRUNE_INTERVAL, if the
+    store has gone over its size, the least recently used ones are. Gives the
+    buildah run flags.
+    """
+    specs = _cache_specs(caches)
+    if not specs:
+        yield []
+        return
+    with contextlib.ExitStack() as stack:
+        args = []
+        # Always locked in the same order, so two builds can't deadlock
+        for name, target, sharing in specs:
+            path = stack.enter_context(CACHE_MOUNT_STORE.entry(
+                name,
+                lambda root, name=name: {'description': f"cache mount {name}", 'mutable': True},
+            ))
+            if sharing == 'locked':
+                # Names can't have "@" in them, so this can't be an entry's lock
+                stack.enter_context(flock(CACHE_MOUNT_STORE.root / f".{name}@run.lock"))
+            args += ['--volume', f"{path}:{target}"]
+        try:
+            yield args
+        finally:
+            # Ours are still locked, so this won't evict them
+            _prune_cache_mounts()
+
+
+def _prune_cache_mounts():
+    """
+    Prunes the cache mounts store, if it's been CACHE_MOUNT_PRUNE_INTERVAL
+    since the last time. Measuring caches means walking every file in them,
+    so it's not done after every run.
+    """
+    if CACHE_MOUNT_STORE.max_size is None:
+        return
+    stamp = CACHE_MOUNT_STORE.root / '.pruned'
+    try:
+        if time.time() - stamp.stat().st_mtime < CACHE_MOUNT_PRUNE_INTERVAL:
+            return
+    except FileNotFoundError:
+        pass
+    stamp.touch()
+    CACHE_MOUNT_STORE.prune(CACHE_MOUNT_STORE.max_size)
+
+
+def _step(method):
+    """
+    Marks a Container method as a build step, for --analyze to report on.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._analyze_step(method.__name__)
+        return result
+    return wrapper
+
+
+#: Where the step cache keeps its images
+CACHE_REPO = 'localhost/buildahscript-cache'
+
+
 class Container:
+    """
+    A working container.
+
+    If the step cache is on (the cache argument, or Container.use_cache), each
+    step (run(), copy_in(), add_url()) is first looked up by its parent image,
+    the container config, and the step's arguments. On a hit, the container is
+    swapped for one made from the image that step produced last time; on a
+    miss, the step is done and the result committed for next time.
+
+    Anything done through mount() can't be tracked, so caching stops from
+    that point on. So does a run() with stdin, or with output to capture
+    (subprocess.DEVNULL is fine).
+    """
     _id: str
 
+    #: Default for the step cache, set by --layer-cache
+    use_cache = False
+    #: Whether to report what each step adds to the filesystem, set by --analyze
+    analyze_steps = False
+
+    _CONFIG_ATTRS = ('environ', 'command', 'entrypoint', 'labels', 'volumes', 'workdir')
+
     environ: typing.Dict[str, str]
     command: typing.List[str]
     entrypoint: typing.List[str]
@@ -76,52 +228,166 @@ class Container:
     def __repr__(self):
         return f'<{type(self).__name__} {self._id}>'
 
-    def __init__(self, image, *, mounts=None):
+    def __init__(self, image, *, mounts=None, cache=None, pull=None):
+        """
+        * image: The image to start from, or "scratch"
+        * mounts: Volumes to mount for the life of the container
+        * cache: Whether to use the step cache
+        * pull: The pull policy for image (see Image)
+        """
         args = []
         if mounts:
             for mntinfo in mounts:
                 args += ['--volume', ':'.join(map(str, mntinfo))]
-        proc = _buildah('from', *args, str(image))
+        self._from_args = args
+        self._cache = self.use_cache if cache is None else cache
+        self._generation = 0
+        self._init_mounts()
+        image = str(image)
+        if image == 'scratch':
+            proc = _buildah('from', *args, image)
+        else:
+            try:
+                proc = _buildah('from', *args, Image._resolve(image, pull))
+            except subprocess.CalledProcessError:
+                # Maybe the image went away behind our backs; try again fresh
+                _images.invalidate()
+                proc = _buildah('from', *args, Image._resolve(image, pull))
         self._id = proc.stdout.strip()
-        self._init_config()
+        cleanup.created('container', self._id)
+        self._last_scan = None
+        if self.analyze_steps:
+            self._last_scan = self.analyze()
+            print(f"[analyze] {image}: {format_size(self._last_scan.total)}", file=sys.stderr)
 
     @classmethod
     def _from_id_only(cls, id):
         # Do magic to avoid creating a container
         self = cls.__new__(cls)
         self._id = id
-        self._init_config()
+        self._from_args = []
+        self._cache = False
+        self._generation = 0
+        self._last_scan = None
+        self._init_mounts()
         return self
 
+    def __getattr__(self, name):
+        # Only called for missing attributes: load config on first use
+        if name in self._CONFIG_ATTRS:
+            self._init_config()
+            return getattr(self, name)
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    def __setattr__(self, name, value):
+        if name in self._CONFIG_ATTRS and name not in vars(self):
+            # Load config before the first change, or there's nothing to tell
+            # that it changed from
+            self._init_config()
+        super().__setattr__(name, value)
+
+    def _changed(self):
+        """
+        Note that the container has changed, so cached inspect data is stale
+        """
+        self._generation += 1
+
     def _init_config(self):
         """
         Initialize the config attrs
         """
         info = self.inspect()
+        # The image this container's current state came from
+        self._parent = info.get('FromImageID') or 'scratch'
         if info['Config']:
             kinda_config = json.loads(info['Config'])
             config = kinda_config['config']  # Might be 'container_config'??
         else:
             config = {}
-        self.environ = dict(
-            item.split('=', 1)
-            for item in config.get('Env') or {}
+        # Around __setattr__, which would load them all over again
+        vars(self).update(
+            environ=dict(
+                item.split('=', 1)
+                for item in config.get('Env') or {}
+            ),
+            command=config.get('Cmd') or [],
+            entrypoint=config.get('Entrypoint') or [],
+            labels=config.get('Labels') or {},
+            volumes=set(config['Volumes'].keys()) if config.get('Volumes') else set(),
+            workdir=config.get('WorkingDir') or "",
         )
-        self.command = config.get('Cmd') or []
-        self.entrypoint = config.get('Entrypoint') or []
-        self.labels = config.get('Labels') or {}
-        self.volumes = set(config['Volumes'].keys()) if config.get('Volumes') else set()
-        self.workdir = config.get('WorkingDir') or ""
         # TODO: ExposedPorts
         # TODO: StopSignal
         # TODO: Author, comment, created by, domainname, shell, user, workingdir
         self._snapshot_config()
 
+    def _reset_config(self):
+        """
+        Forget the config attrs, so they're reloaded on next use
+        """
+        for name in (*self._CONFIG_ATTRS, '_snapshot'):
+            vars(self).pop(name, None)
+
     def _snapshot_config(self):
         """
         Snapshot config for future comparison
         """
-        self._snapshot = copy.deepcopy(vars(self))
+        self._snapshot = copy.deepcopy({
+            name: getattr(self, name)
+            for name in self._CONFIG_ATTRS
+        })
+
+    def _step_key(self, *step):
+        """
+        The step cache key for the given operation, or None if it can't be
+        cached.
+        """
+        if not self._cache:
+            return None
+        # Also loads the config, and with it _parent
+        config = {
+            name: getattr(self, name)
+            for name in self._CONFIG_ATTRS
+        }
+        config['volumes'] = sorted(self.volumes)
+        return hash_key(self._parent, self._from_args, config, *step)
+
+    def _cache_hit(self, key):
+        """
+        If a previous build cached the result of this step, switch the
+        container over to it and return True.
+        """
+        if key is None:
+            return False
+        image = _images.lookup(f"{CACHE_REPO}:{key}")
+        if image is None:
+            return False
+        # Pending config changes are part of the key, so the cached image
+        # already has them.
+        self._release_mount()
+        try:
+            proc = _buildah('from', *self._from_args, image, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            # Removed since we last looked
+            _images.remove(image)
+            return False
+        cleanup.remove_container(self._id)
+        self._id = proc.stdout.strip()
+        cleanup.created('container', self._id)
+        self._changed()
+        self._reset_config()
+        return True
+
+    def _cache_store(self, key):
+        """
+        Commit the result of a step so later builds can skip it.
+        """
+        if key is None:
+            return
+        self._commit_config()
+        proc = _buildah('commit', self._id, f"{CACHE_REPO}:{key}")
+        self._parent = proc.stdout.strip()
+        _images.add(self._parent, [f"{CACHE_REPO}:{key}"])
 
     def _produce_config_args(self):
         """
@@ -144,6 +410,13 @@ class Container:
         for key in env_del:
             args += ['--env', f"{key}-"]
 
+        # Labels
+        label_add, label_del = _dict_diff(self._snapshot['labels'], self.labels)
+        for key in label_add:
+            args += ['--label', f"{key}={self.labels[key]}"]
+        for key in label_del:
+            args += ['--label', f"{key}-"]
+
         # Volumes
         vol_add = self.volumes - self._snapshot['volumes']
         vol_del = self._snapshot['volumes'] - self.volumes
@@ -157,31 +430,85 @@ class Container:
     def _commit_config(self):
         """
         Commit any config changes to buildah
+
+        Config changes pile up until something needs them (run(), commit(),
+        inspect()), and then go out in one `buildah config`.
         """
-        if not hasattr(self, '_snapshot'):
+        if '_snapshot' not in vars(self):
+            # Never loaded, so never changed
             return
         args = self._produce_config_args()
         if args:
             _buildah('config', *args, self._id)
+            self._snapshot_config()
+            self._changed()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        _buildah('rm', self._id, stdout=subprocess.DEVNULL)
+        # rm unmounts for us. It can happen in the background; nothing here
+        # needs the container any more.
+        cleanup.remove_container(self._id)
+        self._mountpoint = None
 
     def inspect(self):
         """
         Return some metadata about the container
         """
         self._commit_config()
-        proc = _buildah('inspect', '--type', 'container', self._id)
-        return json.loads(proc.stdout)
+        cached = vars(self).get('_inspected')
+        if cached is None or cached[0] != self._generation:
+            proc = _buildah('inspect', '--type', 'container', self._id)
+            cached = self._inspected = (self._generation, json.loads(proc.stdout))
+        return copy.deepcopy(cached[1])
 
     def commit(self):
         self._commit_config()
+        if self.analyze_steps:
+            self.analyze().report()
+        self._release_mount()
         proc = _buildah('commit', self._id)
-        return Image._from_id_only(proc.stdout.strip())
+        id = proc.stdout.strip()
+        _images.add(id)
+        return Image._from_id_only(id)
+
+    def analyze(self, *, jobs=8):
+        """
+        Measures the container's filesystem, returning an analyze.Snapshot
+        with the total size and the largest directories and files. Compare
+        two with Snapshot.diff() to see what the steps in between added.
+
+        jobs directories are listed at once.
+        """
+        from .analyze import scan
+
+        with trace.span('analyze') as info:
+            with self._mount() as root:
+                snapshot = scan(root, jobs=jobs)
+            info['files'] = snapshot.files
+            return snapshot
+
+    def _analyze_step(self, step):
+        """
+        With --analyze, report what the step just run did to the filesystem.
+        """
+        if not self.analyze_steps:
+            return
+        before, after = self._last_scan, self.analyze()
+        self._last_scan = after
+        line = trace.script_line()
+        where = f" (line {line})" if line is not None else ''
+        if before is None:
+            print(f"[analyze] {step}{where}: now {format_size(after.total)}", file=sys.stderr)
+            return
+        diff = after.diff(before, count=5)
+        print(
+            f"[analyze] {step}{where}: {diff}; now {format_size(after.total)}",
+            file=sys.stderr,
+        )
+        for size, path, how in diff.largest:
+            print(f"  {format_size(size):>9}  {how:<8}  {path}", file=sys.stderr)
 
     @contextlib.contextmanager
     def mount(self):
@@ -190,12 +517,80 @@ class Container:
 
         The context manager returns a pathlib.Path, which points to the mount
         point.
+
+        Nested and concurrent mounts share one `buildah mount`. See also
+        mount_session().
         """
-        proc = _buildah('mount', self._id)
-        path = proc.stdout.strip()
-        yield pathlib.Path(path)
-        _buildah('umount', self._id)
+        # We can't know what's done to the filesystem, so the step cache can't
+        # follow us past here.
+        self._cache = False
+        with self._mount() as root:
+            yield root
 
+    @contextlib.contextmanager
+    def mount_session(self):
+        """
+        Keeps the container's filesystem mounted once something mounts it,
+        until the end of the session. Context manager.
+
+        Inside a session, any number of mount(), copy_out() and add_url()
+        calls cost a single mount/umount pair. commit() still unmounts (unless
+        a mount() is in progress), and the next use mounts again.
+        """
+        with self._mount_lock:
+            self._mount_sessions += 1
+        try:
+            yield
+        finally:
+            with self._mount_lock:
+                self._mount_sessions -= 1
+                if not self._mount_sessions and not self._mount_users:
+                    self._umount()
+
+    def _init_mounts(self):
+        self._mount_lock = threading.Lock()
+        self._mount_users = 0
+        self._mount_sessions = 0
+        self._mountpoint = None
+
+    @contextlib.contextmanager
+    def _mount(self):
+        """
+        Reference counted mounting
+        """
+        with self._mount_lock:
+            if self._mountpoint is None:
+                proc = _buildah('mount', self._id)
+                self._mountpoint = pathlib.Path(proc.stdout.strip())
+                cleanup.created('mount', self._id)
+                self._changed()
+            self._mount_users += 1
+            root = self._mountpoint
+        try:
+            yield root
+        finally:
+            with self._mount_lock:
+                self._mount_users -= 1
+                if not self._mount_sessions and not self._mount_users:
+                    self._umount()
+
+    def _umount(self):
+        # Call with _mount_lock held
+        if self._mountpoint is not None:
+            self._mountpoint = None
+            _buildah('umount', self._id, stdout=subprocess.DEVNULL)
+            cleanup.released('mount', self._id)
+            self._changed()
+
+    def _release_mount(self):
+        """
+        Unmount if all that's holding the mount is a session.
+        """
+        with self._mount_lock:
+            if not self._mount_users:
+                self._umount()
+
+    @_step
     def copy_in(self, src, dst):
         """
         Copies a file or directory from the host into the container.
@@ -206,47 +601,108 @@ class Container:
         This is wrong: copy_in("myfile", "/usr/bin")
         This is right: copy_in("myfile", "/usr/bin/foobar")
         """
+        _note_input(src)
+        # Hashing reads all of src, so only if there's a cache to look in
+        key = self._step_key('copy', hash_path(src), str(dst)) if self._cache else None
+        if self._cache_hit(key):
+            return
         _buildah('copy', self._id, str(src), str(dst))
+        self._changed()
+        self._cache_store(key)
+
+    @_step
+    def copy_in_many(self, files, *, jobs=8):
+        """
+        Copies many files into the container at once.
+
+        files maps each destination in the container (which, as with
+        copy_in(), must include the name that will be taken) to either a
+        host path (file or directory) or bytes to use as the file's contents.
+
+        Rather than a `buildah copy` per file, the container is mounted once
+        and jobs files written at a time. Directories are merged into what's
+        already there.
+
+        Returns a CopyStats of what was transferred.
+        """
+        import concurrent.futures
+        from ._fsutil import CopyStats, add_stats, copy_tree, resolve_in_root
+
+        start = time.perf_counter()
+        files = {str(dst): src for dst, src in files.items()}
+        for src in files.values():
+            if not isinstance(src, bytes):
+                _note_input(src)
+        if not all(dst.startswith('/') for dst in files):
+            raise NotImplementedError("Resolving relative paths not implemented")
+        for dst in files:
+            if dst.rstrip('/').rsplit('/', 1)[-1] in ('', '.', '..'):
+                raise ValueError(f"Destination {dst!r} must end in the name to be taken")
+
+        key = self._step_key('copy_many', sorted(
+            (dst, hashlib.sha256(src).hexdigest() if isinstance(src, bytes) else hash_path(src))
+            for dst, src in files.items()
+        )) if self._cache else None
+        if self._cache_hit(key):
+            return CopyStats(seconds=time.perf_counter() - start)
+
+        stats = CopyStats()
+        with self._mount() as root:
+            def put(item):
+                dst, src = item
+                parent, name = dst.rstrip('/').rsplit('/', 1)
+                hostparent = resolve_in_root(root, parent)
+                os.makedirs(hostparent, exist_ok=True)
+                hostdst = os.path.join(hostparent, name)
+                if isinstance(src, bytes):
+                    # Replace a symlink (which might point anywhere on the
+                    # host) rather than writing through it
+                    if os.path.islink(hostdst):
+                        os.unlink(hostdst)
+                    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+                    with open(os.open(hostdst, flags, 0o666), 'wb') as fobj:
+                        fobj.write(src)
+                    return CopyStats(files_copied=1, bytes_copied=len(src))
+                else:
+                    return copy_tree(
+                        src, hostdst, sync=True, delete=False, overwrite=True, jobs=jobs,
+                    )
+
+            with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+                for result in pool.map(put, files.items()):
+                    add_stats(stats, result)
+
+        self._cache_store(key)
+        stats.seconds = time.perf_counter() - start
+        return stats
 
-    def copy_out(self, src, dst):
+    def copy_out(self, src, dst, *, sync=False, checksum=False, jobs=8):
         """
         Copies a file or directory out of the container to the host.
 
         dst must include the name that will be taken, not just the parent
         directory.
+
+        Additional arguments:
+        * sync: Instead of replacing dst, only copy what's changed (by size
+          and modification time) and delete what's gone
+        * checksum: With sync, also compare file contents
+        * jobs: How many files to copy at once
+
+        Returns a CopyStats of what was transferred.
         """
-        dst = pathlib.Path(dst)
-        # Cleanup what already exists
-        if dst.is_dir():
-            shutil.rmtree(dst)
-        elif dst.exists():
-            dst.unlink()
-
-        with self.mount() as root:
-            fullsrc = root / src.lstrip('/')
-            if fullsrc.is_dir():
-                shutil.copytree(fullsrc, dst)
-            else:
-                shutil.copy2(fullsrc, dst)
+        from ._fsutil import copy_tree, resolve_in_root
 
-    def run(
-        self, cmd, *,
-        # buildah flags
-        shell=False, user=None, volumes=None, mounts=None, terminal=False,
-        # TODO: cap add/drop, hostname, ipc, isolation, network, pid, uts
-        # Subprocess flags
-        stdin=None, input=None, stdout=None, stderr=None, text=None,
-        # TODO: timeout, cwd, env
-    ):
-        self._commit_config()
+        with self._mount() as root:
+            fullsrc = resolve_in_root(root, src)
+            return copy_tree(fullsrc, dst, sync=sync, checksum=checksum, jobs=jobs)
+
+    @staticmethod
+    def _run_args(*, shell, user, volumes, mounts, terminal):
+        """
+        The buildah run flags for run()'s options
+        """
         args = []
-        opts = {
-            'stdin': stdin,
-            'input': input,
-            'stdout': stdout,
-            'stderr': stderr,
-            'text': text,
-        }
 
         if user is not None:
             args += ['--user', str(user)]
@@ -270,28 +726,430 @@ class Container:
         if shell:
             raise NotImplementedError("shell not implemented yet")
 
-        return _buildah('run', *args, '--', self._id, *cmd, **opts)
+        return args
 
-    def add_url(self, url, dest, *, chmod=None):
+    @_step
+    def run(
+        self, cmd, *,
+        # buildah flags
+        shell=False, user=None, volumes=None, mounts=None, terminal=False,
+        # TODO: cap add/drop, hostname, ipc, isolation, network, pid, uts
+        # Cache mounts, see _cache_mounts()
+        caches=None,
+        # Subprocess flags
+        stdin=None, input=None, stdout=None, stderr=None, text=None,
+        # TODO: timeout, cwd, env
+    ):
+        args = self._run_args(
+            shell=shell, user=user, volumes=volumes, mounts=mounts, terminal=terminal,
+        )
+        opts = {
+            'stdin': stdin,
+            'input': input,
+            'stdout': stdout,
+            'stderr': stderr,
+            'text': text,
+        }
+
+        if stdin is not None and stdin != subprocess.DEVNULL:
+            # Whatever gets fed in can't be part of the key
+            self._cache = False
+        if {stdout, stderr} - {None, subprocess.DEVNULL}:
+            # A cache hit has no output to give back, so this has to run; and
+            # since it's committed afresh each time, what comes after it can't
+            # be found again either
+            self._cache = False
+        # What's in the caches doesn't count, only where they go
+        key = self._step_key('run', args, list(cmd), input, _cache_specs(caches))
+        if self._cache_hit(key):
+            return subprocess.CompletedProcess([*args, *cmd], 0)
+        self._commit_config()
+        with _cache_mounts(caches) as cache_args:
+            proc = _buildah('run', *args, *cache_args, '--', self._id, *cmd, **opts)
+        self._changed()
+        self._cache_store(key)
+        return proc
+
+    def run_stream(
+        self, cmd, *,
+        # buildah flags
+        shell=False, user=None, volumes=None, mounts=None, caches=None,
+        # Streaming
+        stdin=None, stdout=subprocess.PIPE, stderr=None, text=False, timeout=None,
+        check=True,
+    ):
+        """
+        Like run(), but starts the command and returns a StreamingRun to
+        follow it with, instead of waiting for it to finish. Memory use stays
+        the same no matter how much data goes in or out.
+
+        * stdin: None (inherited), a file or file descriptor, bytes or str,
+          an iterable of bytes or str (fed in as the command reads it), or
+          subprocess.PIPE, to write bytes to StreamingRun.stdin yourself
+        * stdout, stderr: subprocess.PIPE to iterate over with
+          StreamingRun.lines() or .chunks(), a callable to be called with
+          each line (from another thread), a file or file descriptor, or None
+          to inherit
+        * text: Give str instead of bytes
+        * timeout: Cancel the command after this many seconds
+        * check: Have wait() raise CalledProcessError if the command fails
+
+        Usable as a context manager, which waits for the command to finish
+        (or cancels it, on an exception).
+        """
+        args = self._run_args(
+            shell=shell, user=user, volumes=volumes, mounts=mounts, terminal=False,
+        )
+        # The output isn't reproducible, so there's no skipping this; and
+        # what comes after can't be either
+        self._cache = False
+        self._commit_config()
+        self._changed()
+        with contextlib.ExitStack() as stack:
+            cache_args = stack.enter_context(_cache_mounts(caches))
+            proc = StreamingRun(
+                ['buildah', 'run', *args, *cache_args, '--', self._id, *cmd], container=self,
+                stdin=stdin, stdout=stdout, stderr=stderr, text=text, timeout=timeout,
+                check=check,
+            )
+            # Kept until the command is done with them
+            proc._hold = stack.pop_all()
+        return proc
+
+    @_step
+    def add_url(self, url, dest, *, chmod=None, sha256=None):
         """
         Download a file at the given URL and put it at dest.
 
         Fails if the server returns an error.
 
+        Downloads are cached on the host, and revalidated with the server on
+        later builds.
+
         Additional arguments:
         * chmod: If set, the unix permissions are set to this
+        * sha256: If set, the download must have this checksum. This also lets
+          a cached copy be used without asking the server.
         """
-        with self.mount() as root:
-            if dest.startswith('/'):
+        from . import download
+        from ._fsutil import copy_file
+
+        if not dest.startswith('/'):
+            raise NotImplementedError("Resolving relative paths not implemented")
+
+        if url.startswith('file:'):
+            import urllib.parse
+            import urllib.request
+
+            _note_input(urllib.request.url2pathname(urllib.parse.urlparse(url).path))
+        with download.fetch(url, sha256=sha256) as blob:
+            # Downloads are stored by their sha256
+            key = self._step_key('add_url', blob.parent.name, dest, chmod)
+            if self._cache_hit(key):
+                return
+            with self._mount() as root:
                 hostdest = root / dest.lstrip('/')
+                copy_file(blob, hostdest)
+
+                if chmod is not None:
+                    hostdest.chmod(chmod)
+        self._cache_store(key)
+
+
+class _Stream:
+    """
+    One of a command's output pipes, read by a thread of its own.
+    """
+    #: How much to read at once
+    CHUNK_SIZE = 64 * 1024
+    #: How many chunks can be waiting to be read before the command is made to
+    #: wait (by way of the pipe filling up)
+    QUEUE_CHUNKS = 16
+
+    def __init__(self, pipe, *, callback, text):
+        import codecs
+        import queue
+
+        self._pipe = pipe
+        self._callback = callback
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace') if text else None
+        self._queue = queue.Queue(self.QUEUE_CHUNKS)
+        self._discard = False
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        partial = None
+        try:
+            # Unbuffered, so this gives whatever's there, up to CHUNK_SIZE
+            for chunk in iter(lambda: self._pipe.read(self.CHUNK_SIZE), b''):
+                if self._decoder is not None:
+                    chunk = self._decoder.decode(chunk)
+                if self._callback is not None:
+                    lines, partial = _split_lines(chunk, partial)
+                    for line in lines:
+                        self._callback(line)
+                elif not self._discard:
+                    self._queue.put(chunk)
+            if self._decoder is not None:
+                tail = self._decoder.decode(b'', final=True)
+                if self._callback is not None:
+                    lines, partial = _split_lines(tail, partial)
+                    for line in lines:
+                        self._callback(line)
+                elif tail and not self._discard:
+                    self._queue.put(tail)
+            if partial:
+                self._callback(partial)
+        finally:
+            self._pipe.close()
+            self._queue.put(None)
+
+    def chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                # For anyone else iterating
+                self._queue.put(None)
+                return
+            yield chunk
+
+    def lines(self):
+        partial = None
+        for chunk in self.chunks():
+            lines, partial = _split_lines(chunk, partial)
+            yield from lines
+        if partial:
+            yield partial
+
+    def discard(self):
+        """
+        Throw away anything not read yet, and from now on
+        """
+        import queue
+
+        self._discard = True
+        with contextlib.suppress(queue.Empty):
+            while True:
+                if self._queue.get_nowait() is None:
+                    self._queue.put(None)
+                    break
+
+    def join(self):
+        self._thread.join()
+
+
+#: Lines longer than this are given in pieces, so memory stays bounded
+MAX_LINE = 1024 * 1024
+
+
+def _split_lines(chunk, partial):
+    """
+    Splits chunk into complete lines (keeping the line endings), continuing
+    partial. Returns the lines and what's left over.
+    """
+    if partial:
+        chunk = partial + chunk
+    newline = '\n' if isinstance(chunk, str) else b'\n'
+    lines = chunk.split(newline)
+    rest = lines.pop()
+    lines = [line + newline for line in lines]
+    while len(rest) > MAX_LINE:
+        lines.append(rest[:MAX_LINE])
+        rest = rest[MAX_LINE:]
+    return lines, rest
+
+
+class StreamingRun:
+    """
+    A command running in a container, from Container.run_stream().
+
+    Iterating over it gives lines of stdout.
+    """
+
+    #: After cancel() asks nicely, how long to wait before insisting
+    KILL_AFTER = 5
+
+    def __init__(self, cmd, *, container, stdin, stdout, stderr, text, timeout, check):
+        self.args = cmd
+        self._container = container
+        self._check = check
+        self._timeout = timeout
+        self.timed_out = False
+        self._streams = {}
+        self._feeder = None
+        self._hold = contextlib.ExitStack()
+
+        feed = None
+        if stdin is None or stdin in (subprocess.PIPE, subprocess.DEVNULL) or isinstance(stdin, int):
+            popen_stdin = stdin
+        elif _has_fileno(stdin):
+            popen_stdin = stdin
+        else:
+            popen_stdin = subprocess.PIPE
+            if isinstance(stdin, (bytes, str)):
+                feed = [stdin]
+            elif hasattr(stdin, 'read'):
+                feed = iter(lambda: stdin.read(_Stream.CHUNK_SIZE), stdin.read(0))
             else:
-                raise NotImplementedError("Resolving relative paths not implemented")
-            with urllib.request.urlopen(url) as src:
-                with hostdest.open('wb') as dest:
-                    shutil.copyfileobj(src, dest)
+                feed = stdin
+
+        outputs = {'stdout': stdout, 'stderr': stderr}
+        popen_out = {
+            name: subprocess.PIPE if callable(dest) else dest
+            for name, dest in outputs.items()
+        }
+
+        self._span = trace.span('buildah run', 'buildah', cmd=cmd, streamed=True)
+        self._info = self._span.__enter__()
+        self.process = subprocess.Popen(
+            cmd, stdin=popen_stdin, bufsize=0, **popen_out,
+        )
+        #: With stdin=subprocess.PIPE, the pipe to write to
+        self.stdin = self.process.stdin if stdin == subprocess.PIPE else None
+
+        for name, dest in outputs.items():
+            if dest == subprocess.PIPE or callable(dest):
+                self._streams[name] = _Stream(
+                    getattr(self.process, name),
+                    callback=dest if callable(dest) else None, text=text,
+                )
+
+        if feed is not None:
+            self._feeder = threading.Thread(target=self._feed, args=(feed,), daemon=True)
+            self._feeder.start()
+
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._time_out)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.args[-1]!r} pid={self.process.pid}>'
+
+    def _feed(self, items):
+        pipe = self.process.stdin
+        try:
+            for item in items:
+                pipe.write(item.encode('utf-8') if isinstance(item, str) else item)
+        except BrokenPipeError:
+            # It stopped reading; not our problem
+            pass
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                pipe.close()
+
+    def _time_out(self):
+        self.timed_out = True
+        self.cancel()
+
+    @property
+    def returncode(self):
+        return self.process.poll()
+
+    def lines(self, stream='stdout'):
+        """
+        Iterates over the lines of stdout (or stderr) as they come, including
+        line endings. Only for streams that were given as subprocess.PIPE.
+        """
+        return self._streams[stream].lines()
+
+    def chunks(self, stream='stdout'):
+        """
+        Iterates over stdout (or stderr) in chunks as they come, rather than
+        lines.
+        """
+        return self._streams[stream].chunks()
+
+    def __iter__(self):
+        return self.lines()
+
+    def cancel(self):
+        """
+        Stops the command: SIGTERM, then SIGKILL if it hasn't gone after a
+        few seconds.
+        """
+        if self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(self.KILL_AFTER)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def wait(self):
+        """
+        Waits for the command to finish, throwing away any output not read,
+        and returns its exit status.
+
+        Raises subprocess.TimeoutExpired if it was cancelled for taking too
+        long, and (if check was set) CalledProcessError if it failed.
+        """
+        for stream in self._streams.values():
+            if stream._callback is None:
+                stream.discard()
+        self.process.wait()
+        for stream in self._streams.values():
+            stream.join()
+        if self._feeder is not None:
+            self._feeder.join()
+        if self._timer is not None:
+            self._timer.cancel()
+        self._hold.close()
+        if self._span is not None:
+            self._info['status'] = self.process.returncode
+            self._span.__exit__(None, None, None)
+            self._span = None
+            self._container._changed()
+            self._container._analyze_step('run_stream')
+
+        if self.timed_out:
+            raise subprocess.TimeoutExpired(self.args, self._timeout)
+        if self._check and self.process.returncode != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.args)
+        return self.process.returncode
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.cancel()
+            with contextlib.suppress(subprocess.SubprocessError):
+                self.wait()
+        else:
+            self.wait()
+
+
+def _has_fileno(obj):
+    try:
+        obj.fileno()
+    except (AttributeError, OSError, ValueError):
+        # io.BytesIO and friends raise io.UnsupportedOperation, an OSError
+        return False
+    else:
+        return True
 
-            if chmod is not None:
-                hostdest.chmod(chmod)
+
+@dataclasses.dataclass
+class PushResult:
+    """
+    How a push to one destination went
+    """
+    dest: str
+    digest: typing.Optional[str] = None
+    #: Layers sent
+    blobs_copied: int = 0
+    #: Layers the destination already had
+    blobs_skipped: int = 0
+    seconds: float = 0.0
+
+    def __str__(self):
+        return (
+            f"{self.dest}: {self.blobs_copied} layers sent, {self.blobs_skipped} already "
+            f"there, in {self.seconds:.1f}s"
+        )
 
 
 class ImageNotFoundError(Exception):
@@ -300,16 +1158,200 @@ class ImageNotFoundError(Exception):
     """
 
 
+def _normalize_name(name):
+    """
+    Produce the names buildah might know an image name by, roughly following
+    its short name rules.
+    """
+    yield name
+    if '@' not in name and ':' not in name.rsplit('/', 1)[-1]:
+        name += ':latest'
+        yield name
+    first, _, rest = name.partition('/')
+    if not rest or ('.' not in first and ':' not in first and first != 'localhost'):
+        yield f"localhost/{name}"
+        if rest:
+            yield f"docker.io/{name}"
+        else:
+            yield f"docker.io/library/{name}"
+
+
+def _tag_names(tag):
+    """
+    The names buildah gives an image when tagging it with tag.
+    """
+    if '@' not in tag and ':' not in tag.rsplit('/', 1)[-1]:
+        tag += ':latest'
+    first, _, rest = tag.partition('/')
+    if not rest or ('.' not in first and ':' not in first and first != 'localhost'):
+        tag = f"localhost/{tag}"
+    return [tag]
+
+
+class _ImageIndex:
+    """
+    Local images, by ID, digest, and name.
+
+    Loaded with one `buildah images` on first use, then kept up to date as
+    images are committed, tagged, pulled, and removed.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = None  # ident -> id
+        self._idents = {}  # id -> {ident}
+        self.changes = None  # [(method, args)], if recording
+
+    def _load(self):
+        proc = _buildah('images', '--json', '--all')
+        self._keys = {}
+        self._idents = {}
+        for img in json.loads(proc.stdout) or []:
+            self._add(img['id'], [
+                *(img.get('names') or []),
+                *([img['digest']] if img.get('digest') else []),
+            ])
+
+    def _add(self, id, idents):
+        for ident in [id, f"sha256:{id}", *idents]:
+            # A name only belongs to one image at a time
+            old = self._keys.get(ident)
+            if old is not None and old != id:
+                self._idents[old].discard(ident)
+            self._keys[ident] = id
+            self._idents.setdefault(id, set()).add(ident)
+
+    def add(self, id, idents=()):
+        with self._lock:
+            if self.changes is not None:
+                self.changes.append(('add', [id, list(idents)]))
+            if self._keys is not None:
+                self._add(id, idents)
+
+    def remove(self, id):
+        with self._lock:
+            if self.changes is not None:
+                self.changes.append(('remove', [id]))
+            if self._keys is not None:
+                for ident in self._idents.pop(id, ()):
+                    if self._keys.get(ident) == id:
+                        del self._keys[ident]
+
+    def invalidate(self):
+        with self._lock:
+            if self.changes is not None:
+                self.changes.append(('invalidate', []))
+            self._keys = None
+
+    def load(self):
+        """
+        Loads the index now, rather than on first use.
+        """
+        with self._lock:
+            if self._keys is None:
+                self._load()
+
+    def lookup_fresh(self, ident):
+        """
+        Like lookup(), but if the index was loaded a while ago and ident isn't
+        in it, reloads it and looks again, in case something outside this
+        process (another build, a pull) has made it since.
+        """
+        with self._lock:
+            loaded = self._keys is not None
+            id = self.lookup(ident)
+            if id is None and loaded:
+                self.invalidate()
+                id = self.lookup(ident)
+            return id
+
+    def replay(self, changes):
+        """
+        Applies changes recorded by another process's index.
+        """
+        for method, args in changes:
+            getattr(self, method)(*args)
+
+    def lookup(self, ident):
+        """
+        Find the ID of a local image, or None.
+        """
+        with self._lock:
+            if self._keys is None:
+                self._load()
+            for name in _normalize_name(ident):
+                if name in self._keys:
+                    return self._keys[name]
+            if len(ident) >= 3 and all(c in '0123456789abcdef' for c in ident):
+                # Short ID
+                matches = [id for id in self._idents if id.startswith(ident)]
+                if len(matches) == 1:
+                    return matches[0]
+            return None
+
+
+_images = _ImageIndex()
+
+
+def _pull_times():
+    return cache_root() / 'pulls.json'
+
+
+def _pulled_within(name, ttl):
+    """
+    Has name been pulled in the last ttl seconds?
+    """
+    try:
+        with _pull_times().open('rt') as fobj:
+            pulled = json.load(fobj).get(name)
+    except (FileNotFoundError, ValueError):
+        return False
+    return pulled is not None and time.time() - pulled < ttl
+
+
+def _record_pull(name):
+    path = _pull_times()
+    with flock(path.with_suffix('.lock')):
+        try:
+            with path.open('rt') as fobj:
+                times = json.load(fobj)
+        except (FileNotFoundError, ValueError):
+            times = {}
+        times[name] = time.time()
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        with tmp.open('wt') as fobj:
+            json.dump(times, fobj)
+        os.replace(tmp, path)
+
+
+#: Never pull; the image must already be present.
+PULL_NEVER = 'never'
+#: Pull if the image isn't present locally.
+PULL_MISSING = 'missing'
+#: Always pull named images, to pick up updates.
+PULL_ALWAYS = 'always'
+
+
 class Image:
+    """
+    An image in local storage.
+
+    Pull policies are one of PULL_NEVER, PULL_MISSING, PULL_ALWAYS, or a number
+    of seconds: pull if we haven't pulled the name in that long.
+    """
     _id: str
 
-    def __init__(self, ident):
+    #: Default pull policy, set by --pull
+    pull_policy = PULL_MISSING
+
+    def __init__(self, ident, *, pull=None):
         """
         * ident: The hex ID or other identifier of the image
+        * pull: The pull policy, defaulting to Image.pull_policy
 
         Will pull the image if not available.
         """
-        self._id = self._resolve(ident)
+        self._id = self._resolve(ident, pull)
 
     def __str__(self):
         return self._id
@@ -324,19 +1366,169 @@ class Image:
         self._id = id
         return self
 
-    def add_tag(self, tag):
+    def add_tag(self, *tags):
         """
-        Add a name to this image.
+        Add names to this image, all in one go.
 
-        If no tag is given, :latest is used.
+        If a name has no tag, :latest is used.
         """
-        _buildah('tag', self._id, tag)
+        if not tags:
+            return
+        _buildah('tag', self._id, *tags)
+        _images.add(self._id, [name for tag in tags for name in _tag_names(tag)])
+
+    def push(self, *dests, compression=None, level=None, jobs=4):
+        """
+        Pushes the image to each of dests at once. A destination is anything
+        `buildah push` takes: docker://registry/name:tag, oci:/path,
+        dir:/path, and so on (a plain name is a registry).
+
+        * compression: The layer compression: "gzip", "zstd", or
+          "zstd:chunked". By default, whatever buildah uses.
+        * level: The compression level
+        * jobs: How many destinations to push to at once
+
+        With more than one destination, layers are compressed once up front
+        and the same blobs sent to all of them.
+
+        Returns a PushResult for each destination.
+        """
+        import concurrent.futures
+        import tempfile
+
+        args = []
+        if compression is not None:
+            args += ['--compression-format', compression]
+        if level is not None:
+            args += ['--compression-level', str(level)]
+
+        with tempfile.TemporaryDirectory(prefix='buildahscript-push-') as tmp:
+            if len(dests) > 1:
+                # Compress into a blob cache once, locally; the real pushes
+                # then take their layers from it instead of each compressing
+                # them again
+                blobs = os.path.join(tmp, 'blobs')
+                os.mkdir(blobs)
+                args += ['--blob-cache', blobs]
+                self._push_one(f"oci:{os.path.join(tmp, 'warm')}", args, tmp)
+
+            with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+                futures = [pool.submit(self._push_one, dest, args, tmp) for dest in dests]
+                return [future.result() for future in futures]
+
+    #: export() formats, and the buildah transport for each
+    EXPORT_FORMATS = {
+        'oci-archive': 'oci-archive',
+        'docker-archive': 'docker-archive',
+        'oci-dir': 'oci',
+    }
+
+    def export(self, path, format='oci-archive', *, compression=None, level=None, jobs=None):
+        """
+        Writes the image out to a file (or for oci-dir, a directory), for
+        loading somewhere else.
+
+        * format: "oci-archive", "docker-archive", or "oci-dir"
+        * compression, level: The layer compression, as for push()
+        * jobs: How many threads to compress the archive with, defaulting to
+          one per core
+
+        If path ends in .gz or .tgz (or .zst or .tzst), the archive as a whole
+        is compressed as well, as buildah writes it; there's never an
+        uncompressed copy on disk. That's mostly worth it for docker-archive,
+        whose layers aren't compressed otherwise.
+
+        Returns how big the result is, in bytes.
+        """
+        from .export import archive_compression, compress
+
+        if format not in self.EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {format!r}")
+        transport = self.EXPORT_FORMATS[format]
+        args = []
+        if compression is not None:
+            args += ['--compression-format', compression]
+        if level is not None:
+            args += ['--compression-level', str(level)]
+        path = os.path.abspath(path)
+        outer = archive_compression(path) if format != 'oci-dir' else None
+
+        with trace.span('export', format=format, compression=outer) as info:
+            if outer is None:
+                if format != 'oci-dir' and os.path.exists(path):
+                    # buildah won't write over an existing archive
+                    os.unlink(path)
+                _buildah('push', '--quiet', *args, self._id, f"{transport}:{path}")
+                size = info['bytes'] = (
+                    dir_size(path) if format == 'oci-dir' else os.path.getsize(path)
+                )
+                return size
+
+            import tempfile
+
+            with tempfile.TemporaryDirectory(prefix='buildahscript-export-') as tmp:
+                # buildah writes into a pipe, and what comes out is compressed
+                # straight into place
+                fifo = os.path.join(tmp, 'archive')
+                os.mkfifo(fifo)
+                cmd = ['buildah', 'push', '--quiet', *args, self._id, f"{transport}:{fifo}"]
+                proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+
+                def unblock():
+                    # If buildah dies without opening the pipe, opening it
+                    # ourselves lets the reader see the end
+                    proc.wait()
+                    with contextlib.suppress(OSError):
+                        os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+
+                watcher = threading.Thread(target=unblock, daemon=True)
+                watcher.start()
+                partial = f"{path}.{os.getpid()}.tmp"
+                try:
+                    with open(fifo, 'rb') as src, open(partial, 'wb') as dst:
+                        compress(src, dst, outer, jobs=jobs)
+                    watcher.join()
+                    if proc.returncode != 0:
+                        raise subprocess.CalledProcessError(proc.returncode, cmd)
+                    os.rename(partial, path)
+                except BaseException:
+                    proc.kill()
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(partial)
+                    raise
+                size = info['bytes'] = os.path.getsize(path)
+                return size
+
+    def _push_one(self, dest, args, tmp):
+        start = time.perf_counter()
+        digestfile = os.path.join(tmp, f"digest-{hashlib.sha256(dest.encode()).hexdigest()}")
+        try:
+            proc = _buildah(
+                'push', *args, '--digestfile', digestfile, self._id, dest,
+                stderr=subprocess.PIPE,
+            )
+        except subprocess.CalledProcessError as exc:
+            # Only kept back to count blobs; don't lose why it failed
+            sys.stderr.write(exc.stderr or '')
+            raise
+        result = PushResult(dest, seconds=time.perf_counter() - start)
+        with contextlib.suppress(FileNotFoundError):
+            with open(digestfile, 'rt') as fobj:
+                result.digest = fobj.read().strip()
+        for line in proc.stderr.splitlines():
+            if line.startswith('Copying blob'):
+                if 'skipped' in line or 'already exists' in line:
+                    result.blobs_skipped += 1
+                else:
+                    result.blobs_copied += 1
+        return result
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        _buildah('rmi', self._id, stdout=subprocess.DEVNULL)
+        cleanup.remove_image(self._id)
+        _images.remove(self._id)
 
     def inspect(self):
         """
@@ -365,17 +1557,49 @@ class Image:
         yield from json.loads(proc.stdout)
 
     @classmethod
-    def _resolve(cls, id):
-        if any(img['id'] == id for img in cls.list()):
-            return id
+    def _resolve(cls, ident, pull=None):
+        """
+        Find the ID for ident, pulling according to the pull policy.
+
+        Joins the prefetch of ident, if there is one.
+        """
+        if pull is None:
+            with _prefetch_lock:
+                pending = _prefetches.pop(ident, None)
+            if pending is not None:
+                try:
+                    return pending.result()
+                except Exception:
+                    # Try again here, so any error comes from the right place
+                    pass
+        return cls._resolve_now(ident, pull)
+
+    @classmethod
+    def _resolve_now(cls, ident, pull=None):
+        policy = cls.pull_policy if pull is None else pull
+        # A long-lived process (the build server) could have missed it
+        id = _images.lookup_fresh(ident)
+
+        if id is not None:
+            if id.startswith(ident) or ident.startswith('sha256:') or '@' in ident:
+                # IDs and digests don't change; nothing to update
+                return id
+            elif policy in (PULL_NEVER, PULL_MISSING):
+                return id
+            elif policy != PULL_ALWAYS and _pulled_within(ident, policy):
+                return id
+        elif policy == PULL_NEVER:
+            raise ImageNotFoundError(f"Could not find image {ident} locally")
 
-        # TODO: Use `buildah inspect` to test if it's available locally.
         try:
-            proc = _buildah('pull', '--quiet', id, stderr=subprocess.DEVNULL)
+            proc = _buildah('pull', '--quiet', ident, stderr=subprocess.DEVNULL)
         except subprocess.CalledProcessError as exc:
-            raise ImageNotFoundError(f"Could not find image {id}") from exc
+            raise ImageNotFoundError(f"Could not find image {ident}") from exc
         else:
-            return proc.stdout.strip()
+            id = proc.stdout.strip()
+            _images.add(id, [ident])
+            _record_pull(ident)
+            return id
 
     @classmethod
     def pull(cls, name):
@@ -388,9 +1612,160 @@ class Image:
             raise ImageNotFoundError(f"Could not find image {name}") from exc
         else:
             id = proc.stdout.strip()
+            _images.add(id, [name])
+            _record_pull(name)
             return cls._from_id_only(id)
 
 
+_prefetch_lock = threading.Lock()
+_prefetches = {}  # ident -> Future of its ID
+
+
+def prefetch(idents):
+    """
+    Starts resolving (and if need be, pulling) images in the background,
+    under the default pull policy. The first Container() or Image() for each
+    one waits for that instead of starting over.
+    """
+    for ident in idents:
+        with _prefetch_lock:
+            if ident not in _prefetches:
+                _prefetches[ident] = background(Image._resolve_now, ident)
+
+
+def background(func, *args, **kwargs):
+    """
+    Starts func(*args, **kwargs) in a background thread, returning a
+    concurrent.futures.Future for its result.
+
+    Stages that don't depend on each other (pulls, runs, copy_out()s) can
+    proceed at the same time this way.
+    """
+    import concurrent.futures
+
+    # A pool per call, so futures waiting on futures can never starve
+    pool = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='buildahscript')
+    try:
+        return pool.submit(func, *args, **kwargs)
+    finally:
+        # Lets the thread exit once it's done
+        pool.shutdown(wait=False)
+
+
+def parallel(*funcs):
+    """
+    Calls each of the given functions at the same time, returning a list of
+    their results once all of them have finished.
+
+    If any of them raised, the first exception (in argument order) is
+    re-raised.
+    """
+    import concurrent.futures
+
+    futures = [background(func) for func in funcs]
+    concurrent.futures.wait(futures)
+    return [fut.result() for fut in futures]
+
+
+#: What cached_stage() keeps
+STAGE_STORE = Store('stages', max_size=5 * 1024 ** 3)
+
+
+def _code_key(code):
+    """
+    What a function's code does, without where in the file it is, so moving
+    it around doesn't change its key.
+    """
+    return [
+        code.co_code.hex(),
+        list(code.co_names),
+        list(code.co_varnames),
+        [_code_key(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts],
+    ]
+
+
+def _code_names(code):
+    """
+    Every global (or attribute) name the code uses, including nested functions
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def cached_stage(image, *, outputs, inputs=(), key=None, pull=None):
+    """
+    Decorator for a build stage whose only result is files, copied out of
+    the container to the host. The decorated function is called with a fresh
+    Container of image, and the outputs copied out after it returns. Call
+    the decorated function to run the stage.
+
+    The outputs are cached, keyed on the image ID, the contents of the input
+    files, the function's code, the build args it uses, and key. When they
+    all match a previous build, the outputs are copied from the cache, and no
+    container is created at all.
+
+    * image: The image to start from
+    * outputs: Maps paths in the container to where on the host to copy them
+    * inputs: Host files and directories the stage uses (copy_in() sources)
+    * key: Anything else the stage depends on, that can be turned into JSON
+    * pull: The pull policy for image (see Image)
+
+    Anything else the function uses (values from outside it, files it
+    downloads) isn't known to the cache; pass it as key, if it matters.
+
+        @cached_stage('rust:buster', inputs=['cmd'],
+                      outputs={'/tmp/cmd/target/release/cmd': bin / 'cmd'})
+        def build_cmd(build):
+            build.copy_in('cmd', '/tmp/cmd')
+            build.workdir = '/tmp/cmd'
+            build.run(['cargo', 'build', '--release'])
+
+        build_cmd()
+    """
+    from ._fsutil import copy_tree, resolve_in_root
+
+    # Sorted, so the order they're given in doesn't matter to the key
+    outputs = sorted((str(src), dst) for src, dst in outputs.items())
+
+    def decorator(func):
+        @functools.wraps(func)
+        def stage():
+            buildargs = func.__globals__.get('__args__') or {}
+            for path in inputs:
+                _note_input(path)
+            with trace.span('stage', stage=func.__qualname__) as info:
+                stage_key = hash_key(
+                    'stage',
+                    'scratch' if str(image) == 'scratch' else Image._resolve(str(image), pull),
+                    sorted((str(path), hash_path(path)) for path in inputs),
+                    _code_key(func.__code__),
+                    sorted(
+                        (name, buildargs[name]) for name in _code_names(func.__code__)
+                        if name in buildargs
+                    ),
+                    [src for src, _ in outputs],
+                    key,
+                )
+                info['hit'] = stage_key in STAGE_STORE
+
+                def populate(root):
+                    with Container(image, pull=pull) as cont:
+                        func(cont)
+                        with cont._mount() as controot:
+                            for n, (src, _) in enumerate(outputs):
+                                copy_tree(resolve_in_root(controot, src), root / str(n))
+                    return {'description': f"stage {func.__qualname__} from {image}"}
+
+                with STAGE_STORE.entry(stage_key, populate) as entry:
+                    for n, (_, dst) in enumerate(outputs):
+                        copy_tree(entry / str(n), dst)
+        return stage
+    return decorator
+
+
 class ReturnImage(BaseException):
     pass
 
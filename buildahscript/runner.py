@@ -1,8 +1,17 @@
 import ast
+import collections
+import dataclasses
+import hashlib
+import importlib.util
+import marshal
 import os
 import sys
+import types
+import typing
 
-from . import modglobals
+from . import metadata, trace
+from .cache import Store, hash_key
+from .metadata import Metadata, scan_metadata_lines
 
 
 def parse_buildargs(argdefs, argvals):
@@ -20,11 +29,109 @@ def parse_buildargs(argdefs, argvals):
     return buildargs
 
 
-def run_file(filename, buildargs):
-    with open(filename, 'rt') as fobj:
-        tree = ast.parse(fobj.read(), filename)
+@dataclasses.dataclass
+class Script:
+    """
+    A build script, ready to run
+    """
+    metadata: Metadata
+    #: Image references for prefetching, see ImageRefs
+    images: typing.Tuple
+    code: types.CodeType
+    #: The compiled script cache key
+    key: str
+
+
+#: Compiled scripts, by path and contents. Capped at 256MiB by default.
+SCRIPT_STORE = Store('scripts', max_size=256 * 1024 ** 2)
+
+# Scripts already loaded by this process (and its forks), by key
+_loaded = {}
+
+
+def _tool_version():
+    """
+    Identifies the code that turns scripts into Scripts, so upgrading or
+    editing buildahscript invalidates the cache (like the pyc mtime check).
+    """
+    return [
+        (os.path.basename(path), st.st_mtime_ns, st.st_size)
+        for path in (__file__, metadata.__file__)
+        for st in [os.stat(path)]
+    ]
+
+
+def _read(filename):
+    with open(filename, 'rb') as fobj:
+        return fobj.read()
+
+
+def load_script(filename, *, key=None):
+    """
+    Reads, parses, and compiles a script, using the compiled script cache.
+
+    The cache is keyed on the script's path and contents, the Python bytecode
+    version, and the version of buildahscript. If the key is already known
+    (eg, handed over from before the re-exec), the script isn't even read.
+    """
+    with trace.span('load script') as info:
+        source = None
+        if key is None or key not in SCRIPT_STORE:
+            source = _read(filename)
+            key = hash_key(
+                'script', filename, os.path.abspath(filename), hashlib.sha256(source).hexdigest(),
+                importlib.util.MAGIC_NUMBER.hex(), _tool_version(),
+            )
+        if key in _loaded:
+            info['cached'] = 'memory'
+            return _loaded[key]
+        info['cached'] = key in SCRIPT_STORE
+
+        def populate(entry):
+            pairs, images, code = _compile_script(
+                filename, _read(filename) if source is None else source,
+            )
+            with (entry / 'script.marshal').open('wb') as fobj:
+                marshal.dump((pairs, images, code), fobj)
+            return {'description': os.path.abspath(filename)}
+
+        with SCRIPT_STORE.entry(key, populate) as entry:
+            with (entry / 'script.marshal').open('rb') as fobj:
+                pairs, images, code = marshal.load(fobj)
+
+    script = _loaded[key] = Script(
+        metadata=Metadata.from_pairs(pairs), images=images, code=code, key=key,
+    )
+    return script
+
 
-    Return2Call().visit(tree)
+def _compile_script(filename, source):
+    text = importlib.util.decode_source(source)
+    pairs = tuple(scan_metadata_lines(text.splitlines()))
+    with trace.span('parse'):
+        tree = ast.parse(text, filename)
+        Return2Call().visit(tree)
+        images = ImageRefs.find(tree)
+    with trace.span('compile'):
+        code = compile(tree, filename, 'exec')
+    return pairs, images, code
+
+
+def run_file(filename, buildargs, *, script=None):
+    """
+    Runs the script in filename (already loaded as script, if given) with
+    the given build args, returning the image it returned, if any.
+    """
+    # Only needed for actually running, not by the outer process
+    from . import modglobals
+
+    if script is None:
+        script = load_script(filename)
+
+    with trace.span('prefetch') as info:
+        refs = ImageRefs.resolve(script.images, buildargs)
+        info['images'] = sorted(refs)
+        modglobals.prefetch(refs)
 
     sys.path = [os.path.dirname(filename)] + sys.path
 
@@ -38,9 +145,10 @@ def run_file(filename, buildargs):
     glbls.update(buildargs)
     sys.modules['__buildah__'] = modglobals
 
-    code = compile(tree, filename, 'exec')
+    trace.script_file = filename
     try:
-        exec(code, glbls)
+        with trace.span('exec'):
+            exec(script.code, glbls)
     except modglobals.ReturnImage as exc:
         image = exc.args[0]
     else:
@@ -79,3 +187,124 @@ class Return2Call(ast.NodeTransformer):
             ),
             node,
         ))
+
+
+def _count_bindings(tree):
+    """
+    How many times each name is bound anywhere in tree: assigned (in any
+    way), used as a loop, with or except target, imported, defined, or taken
+    as an argument.
+    """
+    counts = collections.Counter()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            counts[node.id] += 1
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                counts[alias.asname or alias.name.split('.')[0]] += 1
+        elif isinstance(node, ast.arg):
+            counts[node.arg] += 1
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            counts[node.name] += 1
+        elif isinstance(node, (ast.ExceptHandler, ast.Global, ast.Nonlocal)):
+            for name in getattr(node, 'names', None) or [node.name]:
+                if name:
+                    counts[name] += 1
+        elif type(node).__name__ in ('MatchAs', 'MatchStar', 'MatchMapping'):
+            # Pattern captures; only from Python 3.10
+            name = getattr(node, 'name', None) or getattr(node, 'rest', None)
+            if name:
+                counts[name] += 1
+    return counts
+
+
+class ImageRefs(ast.NodeVisitor):
+    """
+    Find the images a script starts from, as far as can be told without
+    running it: Container(...), Image(...) and cached_stage(...) calls whose
+    image is a string literal, a build arg, a top-level constant, or an
+    f-string or + of those.
+
+    find() gives templates, tuples of literal strings and (name,) build arg
+    references, which resolve() fills in once the build args are known.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.bound = collections.Counter()
+        self.refs = set()
+
+    @classmethod
+    def find(cls, tree):
+        self = cls()
+        self.bound = _count_bindings(tree)
+        for node in tree.body:
+            # Only trust names that are bound once, by a top-level assignment
+            if isinstance(node, ast.Assign) and len(node.targets) == 1:
+                target = node.targets[0]
+            elif isinstance(node, ast.AnnAssign) and node.value is not None:
+                target = node.target
+            else:
+                continue
+            if isinstance(target, ast.Name) and self.bound[target.id] == 1:
+                value = self.template(node.value)
+                if value is not None:
+                    self.names[target.id] = value
+        self.visit(tree)
+        return tuple(sorted(self.refs, key=repr))
+
+    @staticmethod
+    def resolve(templates, buildargs):
+        refs = set()
+        for template in templates:
+            parts = [
+                part if isinstance(part, str) else buildargs.get(part[0])
+                for part in template
+            ]
+            if all(isinstance(part, str) for part in parts):
+                refs.add(''.join(parts))
+        refs.discard('')
+        refs.discard('scratch')
+        return refs
+
+    def template(self, node):
+        """
+        The template for the string node evaluates to, or None if it can't be
+        told.
+        """
+        if isinstance(node, ast.Constant):
+            return (node.value,) if isinstance(node.value, str) else None
+        elif sys.version_info < (3, 8) and isinstance(node, ast.Str):
+            return (node.s,)
+        elif isinstance(node, ast.Name):
+            # A top-level constant overrides a build arg of the same name
+            if node.id in self.names:
+                return self.names[node.id]
+            # Anything else bound to it could be what's used
+            return None if self.bound[node.id] else ((node.id,),)
+        elif isinstance(node, ast.JoinedStr):
+            parts = [self.template(part) for part in node.values]
+            return None if None in parts else sum(parts, ())
+        elif isinstance(node, ast.FormattedValue):
+            if node.conversion != -1 or node.format_spec is not None:
+                return None
+            return self.template(node.value)
+        elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            left, right = self.template(node.left), self.template(node.right)
+            return None if left is None or right is None else left + right
+        return None
+
+    def visit_Call(self, node):
+        if (
+            isinstance(node.func, ast.Name)
+            and node.func.id in ('Container', 'Image', 'cached_stage')
+            # A pull policy of its own means it's not ours to fetch
+            and not any(kw.arg == 'pull' for kw in node.keywords)
+        ):
+            arg = node.args[0] if node.args else next(
+                (kw.value for kw in node.keywords if kw.arg in ('image', 'ident')), None,
+            )
+            template = None if arg is None else self.template(arg)
+            if template is not None:
+                self.refs.add(template)
+        self.generic_visit(node)
@@ -0,0 +1,136 @@
+"""
+Records where a build spends its time
+"""
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+#: Whether spans are being recorded; set by enable()
+enabled = False
+#: The build script being run, so buildah calls can be traced back to it
+script_file = None
+
+# Carries the outer process's events across the buildah unshare re-exec
+ENV_VAR = 'BUILDAHSCRIPT_TRACE_EVENTS'
+
+_events = []
+_lock = threading.Lock()
+
+
+def enable():
+    global enabled
+    enabled = True
+    if ENV_VAR in os.environ:
+        handed = json.loads(os.environ.pop(ENV_VAR))
+        _events.extend(handed['events'])
+        # Account for the time between exec() and getting here
+        now = time.time_ns()
+        _events.append({
+            'name': 're-exec', 'cat': 'python', 'ph': 'X',
+            'ts': handed['exec'] / 1000, 'dur': (now - handed['exec']) / 1000,
+            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': {},
+        })
+
+
+def hand_off():
+    """
+    Stash the events so far in the environment, for the process we're about
+    to exec.
+    """
+    if enabled:
+        os.environ[ENV_VAR] = json.dumps({'events': _events, 'exec': time.time_ns()})
+
+
+def script_line():
+    """
+    The line of the build script currently executing in this thread, if any.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_filename == script_file:
+            return frame.f_lineno
+        frame = frame.f_back
+    return None
+
+
+@contextlib.contextmanager
+def span(name, category='python', **args):
+    """
+    Records how long the body takes. Context manager, giving a dict of args
+    that the body can add details to.
+    """
+    if not enabled:
+        yield args
+        return
+    line = script_line()
+    if line is not None:
+        args['line'] = line
+    start = time.time_ns()
+    try:
+        yield args
+    finally:
+        end = time.time_ns()
+        with _lock:
+            _events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': start / 1000,
+                'dur': (end - start) / 1000,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+
+def write_chrome_trace(path):
+    """
+    Writes the events as Chrome trace event JSON, which Perfetto and
+    chrome://tracing can open.
+    """
+    with open(path, 'wt') as fobj:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms'}, fobj)
+
+
+def print_summary(file=None, *, slowest=10):
+    """
+    Prints a table of where the time went.
+    """
+    file = file or sys.stderr
+    if not _events:
+        print("No events recorded", file=file)
+        return
+    start = min(e['ts'] for e in _events)
+    wall = time.time_ns() / 1000 - start
+
+    groups = collections.defaultdict(list)
+    for event in _events:
+        groups[event['cat'], event['name']].append(event['dur'])
+
+    print(f"Profile: {wall / 1e6:.3f}s wall", file=file)
+    print(f"  {'what':<32} {'calls':>6} {'total':>9} {'mean':>9} {'max':>9}", file=file)
+    for (category, name), durs in sorted(groups.items(), key=lambda i: -sum(i[1])):
+        print(
+            f"  {name:<32} {len(durs):>6} {sum(durs) / 1e6:>8.3f}s "
+            f"{sum(durs) / len(durs) / 1e6:>8.3f}s {max(durs) / 1e6:>8.3f}s",
+            file=file,
+        )
+
+    calls = sorted(
+        (e for e in _events if e['cat'] == 'buildah'),
+        key=lambda e: -e['dur'],
+    )[:slowest]
+    if calls:
+        print("Slowest buildah calls:", file=file)
+        for event in calls:
+            args = event['args']
+            where = f" (line {args['line']})" if 'line' in args else ''
+            print(
+                f"  {event['dur'] / 1e6:8.3f}s  exit {args.get('status', '?')}  "
+                f"{args.get('stdout_bytes', 0):>8}B  {' '.join(args['cmd'])[:80]}{where}",
+                file=file,
+            )
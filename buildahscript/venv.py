@@ -1,35 +1,217 @@
 """
 Tools to build & populate venvs
 """
+import concurrent.futures
 import contextlib
+import errno
+import importlib.util
 import json
 import os
+import pathlib
+import shutil
 import subprocess
+import sys
+import sysconfig
 import tempfile
 import venv
+import zipfile
+
+from . import trace
+from ._fsutil import copy_file
+from .cache import Store, hash_key
+
+#: Where cached_venv() keeps its venvs. Capped at 2GiB by default.
+VENV_STORE = Store('venvs', max_size=2 * 1024 ** 3)
+
+#: Every wheel any build has used, both as the .whl (for pip to find) and
+#: unpacked (to hardlink into venvs). Capped at 2GiB by default.
+WHEEL_STORE = Store('wheels', max_size=2 * 1024 ** 3)
+
+#: How many wheels to install at once
+INSTALL_JOBS = 8
 
 
 @contextlib.contextmanager
 def make_tmp_venv(reqs):
-    # TODO: Caching?
     with tempfile.TemporaryDirectory() as td:
-        venv.create(td, with_pip=True)
-        pip = os.path.join(td, 'bin', 'pip')
-        subprocess.run([pip, 'install', 'wheel'], check=True)
-        if reqs:
-            subprocess.run([pip, 'install', *reqs], check=True)
-
+        _populate_venv(pathlib.Path(td), reqs)
         yield Venv(td)
 
 
+def _host_pip():
+    """
+    Can we run pip from the interpreter we're running under, instead of
+    installing one into every venv?
+    """
+    return importlib.util.find_spec('pip') is not None
+
+
+def _populate_venv(root, reqs):
+    """
+    Creates a venv in root with reqs installed.
+
+    Wheels for reqs (and their dependencies) are built with `pip wheel` into
+    the wheelhouse, offline if everything's already there. Each wheel is
+    unpacked once, and hardlinked into venvs after that.
+    """
+    borrow_pip = _host_pip()
+    with concurrent.futures.ThreadPoolExecutor(INSTALL_JOBS) as pool:
+        # Set the venv up while pip works out what goes in it
+        created = pool.submit(_create_venv, root, with_pip=not borrow_pip)
+        if borrow_pip:
+            pip = [sys.executable, '-m', 'pip']
+        else:
+            created.result()
+            pip = [str(root / 'bin' / 'python'), '-m', 'pip']
+            subprocess.run([*pip, 'install', '--quiet', 'wheel'], check=True)
+
+        with tempfile.TemporaryDirectory(dir=WHEEL_STORE.root, prefix='.build-') as wheeldir:
+            wheels = _build_wheels(pip, reqs, wheeldir) if reqs else []
+            created.result()
+            site_packages = sysconfig.get_path(
+                'purelib', vars={'base': str(root), 'platbase': str(root)},
+            )
+            with trace.span('install wheels', wheels=len(wheels)):
+                # list() to raise any errors
+                list(pool.map(lambda whl: _install_wheel(whl, site_packages), wheels))
+
+    return {'deps': reqs, 'description': ' '.join(reqs)}
+
+
+def _create_venv(root, *, with_pip):
+    with trace.span('venv create', with_pip=with_pip):
+        venv.create(root, with_pip=with_pip)
+
+
+def _build_wheels(pip, reqs, wheeldir):
+    """
+    Gets wheels for reqs and everything they depend on into wheeldir,
+    returning their paths.
+    """
+    with tempfile.TemporaryDirectory(dir=WHEEL_STORE.root, prefix='.links-') as links:
+        # pip only looks at the top of a --find-links directory
+        for entry in WHEEL_STORE.root.iterdir():
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            for whl in (entry / 'wheel').glob('*.whl'):
+                with contextlib.suppress(FileExistsError):
+                    os.symlink(whl, os.path.join(links, whl.name))
+
+        cmd = [*pip, 'wheel', '--quiet', '--wheel-dir', wheeldir, '--find-links', links]
+        with trace.span('pip wheel', deps=reqs) as info:
+            proc = subprocess.run(
+                [*cmd, '--no-index', *reqs],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            info['offline'] = proc.returncode == 0
+            if proc.returncode != 0:
+                # Something's missing from the wheelhouse, go get it
+                subprocess.run([*cmd, *reqs], check=True)
+
+    return sorted(pathlib.Path(wheeldir).glob('*.whl'))
+
+
+def _install_wheel(whl, site_packages):
+    """
+    Puts the wheel into the wheelhouse (if it's new) and links its contents
+    into site_packages.
+    """
+    def populate(entry):
+        (entry / 'wheel').mkdir()
+        os.link(whl, entry / 'wheel' / whl.name)
+        _unpack_wheel(whl, entry / 'unpacked')
+        return {'description': whl.name}
+
+    # Wheel file names are unique (name, version, and tags)
+    with WHEEL_STORE.entry(hash_key('wheel', whl.name), populate) as entry:
+        _link_tree(entry / 'unpacked', site_packages)
+
+
+def _unpack_wheel(whl, dest):
+    """
+    Unpacks a wheel the way it would be laid out in site-packages. Only
+    libraries are kept: scripts, headers, and data files are left out.
+    """
+    with zipfile.ZipFile(whl) as zf:
+        for info in zf.infolist():
+            path = info.filename
+            top, _, rest = path.partition('/')
+            if top.endswith('.data'):
+                kind, _, path = rest.partition('/')
+                if kind not in ('purelib', 'platlib'):
+                    continue
+            target = dest / path
+            if info.is_dir():
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with zf.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            mode = info.external_attr >> 16
+            if mode:
+                os.chmod(target, mode & 0o777)
+
+
+def _link_tree(src, dst):
+    """
+    Hardlinks every file in src into dst, creating directories as needed.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target, exist_ok=True)
+        for name in filenames:
+            srcfile, dstfile = os.path.join(dirpath, name), os.path.join(target, name)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(dstfile)
+            try:
+                os.link(srcfile, dstfile)
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                copy_file(srcfile, dstfile)
+
+
+def normalize_reqs(reqs):
+    """
+    Put a list of requirements in a canonical form, so trivially different
+    lists share a cache entry.
+    """
+    return sorted({' '.join(req.split()) for req in reqs})
+
+
+@contextlib.contextmanager
+def cached_venv(reqs):
+    """
+    Like make_tmp_venv(), but reuses a venv from a previous build with the same
+    requirements and interpreter.
+
+    The venv is protected from eviction for the life of the context, including
+    across an exec().
+    """
+    reqs = normalize_reqs(reqs)
+    key = hash_key('venv', reqs, sys.version, os.path.realpath(sys.executable))
+
+    with VENV_STORE.entry(key, lambda root: _populate_venv(root, reqs), inheritable=True) as root:
+        meta = VENV_STORE.read_meta(key)
+        # The venv was built in a temporary directory, so ask where it lives now
+        if meta.get('root') != str(root):
+            meta['root'] = str(root)
+            meta['python_path'] = Venv(root).python_path()
+            VENV_STORE.write_meta(key, meta)
+        yield Venv(root, python_path=meta['python_path'])
+
+
 class Venv:
-    def __init__(self, root):
+    def __init__(self, root, *, python_path=None):
         self.root = root
+        self._python_path = python_path
 
     def bin(self, program):
         return os.path.join(self.root, 'bin', program)
 
     def python_path(self):
+        if self._python_path is not None:
+            return self._python_path
         proc = subprocess.run(
             [self.bin('python'), '-c', "print(__import__('json').dumps(__import__('sys').path))"],
             stdout=subprocess.PIPE, check=True
@@ -0,0 +1,260 @@
+"""
+Rebuilds whenever what a build read from the host changes
+
+The watching process stays inside buildah unshare with everything imported,
+and runs each build in a fork of itself (as the build server does). Builds
+use the step cache, so each one picks up from the first step whose inputs
+changed, starting from the image the last build left there.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from .daemon import fork_build, reap_build
+
+#: How long changes have to stop for before rebuilding
+DEBOUNCE = 0.3
+#: How often to look for changes, without inotify
+POLL_INTERVAL = 0.5
+
+# Editors write these beside the files being edited; they're not changes
+_IGNORE_SUFFIXES = ('~', '.swp', '.swx', '.swo')
+_IGNORE_NAMES = ('4913',)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+    | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+_EVENT = struct.Struct('iIII')
+
+
+def _ignored(path):
+    name = os.path.basename(path)
+    return name.endswith(_IGNORE_SUFFIXES) or name.startswith('.#') or name in _IGNORE_NAMES
+
+
+def _relevant(path, paths):
+    """
+    If path is one of paths, or inside one of them
+    """
+    return any(path == p or path.startswith(p + os.sep) for p in paths)
+
+
+class _Inotify:
+    """
+    Watches directories with inotify, by way of ctypes.
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}  # watch descriptor -> directory
+
+    def close(self):
+        os.close(self.fd)
+
+    def add(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), _MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # Gone again already
+                return
+            raise OSError(err, f"Can't watch {directory}")
+        self._dirs[wd] = directory
+
+    def add_tree(self, directory):
+        self.add(directory)
+        for dirpath, dirnames, _ in os.walk(directory):
+            for name in dirnames:
+                self.add(os.path.join(dirpath, name))
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds for events, giving the paths they're
+        about. None means the kernel dropped some, so anything may have
+        changed.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Keep up with new directories
+                self.add_tree(path)
+            paths.append(path)
+        return paths
+
+
+def _watch_inotify(paths):
+    """
+    Waits for any of paths (files or directory trees) to change, with
+    inotify. Returns the paths that changed.
+    """
+    notify = _Inotify()
+    try:
+        for path in paths:
+            if os.path.isdir(path):
+                notify.add_tree(path)
+            else:
+                # Editors often replace files rather than writing to them, so
+                # watch the directory instead
+                notify.add(os.path.dirname(path))
+
+        changed = set()
+        timeout = None
+        while True:
+            events = notify.read(timeout)
+            if events is None:
+                return set(paths)
+            events = [p for p in events if _relevant(p, paths) and not _ignored(p)]
+            if events:
+                changed.update(events)
+                timeout = DEBOUNCE
+            elif changed:
+                # Quiet for long enough
+                return changed
+    finally:
+        notify.close()
+
+
+def _snapshot(paths):
+    """
+    The modification times and sizes of everything in paths
+    """
+    state = {}
+    for path in paths:
+        for dirpath, dirnames, filenames in os.walk(path) if os.path.isdir(path) else [('', [], [path])]:
+            for name in [*dirnames, *filenames]:
+                full = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(full)
+                except FileNotFoundError:
+                    continue
+                state[full] = (st.st_mtime_ns, st.st_size, st.st_mode)
+        if not os.path.lexists(path):
+            state[path] = None
+    return state
+
+
+def _watch_polling(paths):
+    """
+    Waits for any of paths to change, by checking on them every so often.
+    Returns the paths that changed.
+    """
+    before = _snapshot(paths)
+    changed = set()
+    while True:
+        time.sleep(DEBOUNCE if changed else POLL_INTERVAL)
+        after = _snapshot(paths)
+        new = {
+            p for p in before.keys() | after.keys()
+            if before.get(p) != after.get(p) and not _ignored(p)
+        }
+        before = after
+        if new:
+            changed |= new
+        elif changed:
+            return changed
+
+
+def wait_for_change(paths):
+    """
+    Blocks until any of paths (files or directory trees) changes, and
+    changes stop for a moment. Returns the paths that changed.
+
+    Uses inotify where there is one, and otherwise polls.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return _watch_inotify(paths)
+        except (OSError, AttributeError) as exc:
+            # No inotify in libc, or out of watches
+            print(f"Can't use inotify ({exc}), polling instead", file=sys.stderr)
+    return _watch_polling(paths)
+
+
+def run(args):
+    """
+    Builds the script, then again every time what it read changes, until
+    interrupted.
+    """
+    from . import modglobals
+
+    modglobals._images.load()
+    request = {
+        'script': os.path.abspath(args.script),
+        'args': args.args,
+        'tags': args.tags,
+        'push': args.push,
+        'export': args.export and os.path.abspath(args.export),
+        'export_format': args.export_format,
+        'compression': args.compression,
+        'compression_level': args.compression_level,
+        # Picking up where the last build's inputs stopped matching is the
+        # whole point
+        'layer_cache': True,
+        'analyze': args.analyze,
+        'pull': args.pull,
+        'cwd': os.getcwd(),
+    }
+    pid = None
+    try:
+        while True:
+            start = time.monotonic()
+            pid, pipes = fork_build(request, capture=False)
+            (fd,) = pipes
+            with os.fdopen(fd, 'rb') as fobj:
+                result = reap_build(pid, fobj.read())
+            pid = None
+            seconds = time.monotonic() - start
+            if result['status'] == 0:
+                print(f"Built {result['image']} in {seconds:.1f}s", file=sys.stderr)
+            else:
+                print(f"Build failed with status {result['status']} after {seconds:.1f}s", file=sys.stderr)
+
+            inputs = result.get('inputs') or [request['script']]
+            print(f"Watching {len(inputs)} paths for changes (Ctrl-C to stop)", file=sys.stderr)
+            changed = sorted(wait_for_change(inputs))
+            shown = ', '.join(os.path.relpath(p) for p in changed[:3])
+            if len(changed) > 3:
+                shown += f" and {len(changed) - 3} more"
+            print(f"\nChanged: {shown}; rebuilding", file=sys.stderr)
+    except KeyboardInterrupt:
+        if pid is not None:
+            # It got the Ctrl-C too; let it clean up after itself
+            os.waitpid(pid, 0)
+        return 0